@@ -0,0 +1,29 @@
+from ijr.firefly import LazyNamespace, NestedNamespace, SecretCache, Secrets
+
+
+def test_nested_namespace(benchmark, document):
+    ns = benchmark(NestedNamespace, document)
+    assert ns.rows.i999.sku == 'sku-000999'
+
+
+def test_lazy_namespace_one_row(benchmark, document):
+    assert benchmark(lambda: LazyNamespace(document).rows[999].sku) == 'sku-000999'
+
+
+def test_dot_secret_uncached(benchmark, secret_manager):
+    secrets = Secrets('project', cache=False)
+    secrets.client = secret_manager
+    assert benchmark(secrets.dot_secret, 'PRICES').name == 'prices'
+
+
+def test_dot_secret_cached(benchmark, secret_manager):
+    secrets = Secrets('project', cache=SecretCache())
+    secrets.client = secret_manager
+    assert benchmark(secrets.dot_secret, 'MONGO').MDB_USER == 'user'
+    assert secret_manager.calls == 1
+
+
+def test_dot_secret_cached_lazy(benchmark, secret_manager):
+    secrets = Secrets('project', cache=SecretCache())
+    secrets.client = secret_manager
+    assert benchmark(lambda: secrets.dot_secret('PRICES', lazy=True).rows.i0.sku) == 'sku-000000'
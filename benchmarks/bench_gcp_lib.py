@@ -0,0 +1,56 @@
+from unittest import mock
+
+import pytest
+
+from ijr import gcp_lib
+
+MESSAGES = 2000
+
+
+def messages(document):
+    return [dict(row, _type='Price') for row in document['rows']] * (MESSAGES // len(document['rows']))
+
+
+def publisher(client, **kwargs):
+    with mock.patch.object(gcp_lib, '_publisher_client', return_value=client):
+        return gcp_lib.PubSubPublisher('topic', **kwargs)
+
+
+def publish_all(p, msgs):
+    with p:
+        for msg in msgs:
+            p.publish(msg)
+
+
+def installed(module):
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
+
+@pytest.mark.parametrize('options', [dict(), dict(threshold=250), dict(blocking=False, threshold=250),
+                                     dict(threshold=250, compression='gzip')],
+                         ids=['default', 'threshold', 'non_blocking', 'gzip'])
+def test_publish_flush(benchmark, document, publisher_client, options):
+    msgs = messages(document)
+
+    def setup():
+        return (publisher(publisher_client, **options), msgs), {}
+
+    benchmark.pedantic(publish_all, setup=setup, rounds=5)
+    assert publisher_client.published
+
+
+@pytest.mark.parametrize('encoder', ['json', 'orjson', 'msgpack'])
+def test_publish_encoder(benchmark, document, publisher_client, encoder):
+    if encoder != 'json' and not installed(encoder):
+        pytest.skip('%s not installed' % encoder)
+    msgs = messages(document)
+
+    def setup():
+        return (publisher(publisher_client, threshold=250, encoder=encoder), msgs), {}
+
+    benchmark.pedantic(publish_all, setup=setup, rounds=5)
+    assert publisher_client.published
@@ -0,0 +1,62 @@
+import json
+import random
+
+import pytest
+from bson import Decimal128, ObjectId
+
+from ijr.generic_lib import Compare, FingerprintCache, default_object, dict_compare, json_dumps
+
+
+@pytest.mark.parametrize('list_diff', ['index', 'sequence'])
+def test_compare_result(benchmark, document, changed_document, list_diff):
+    result = benchmark(lambda: Compare(document, changed_document, list_diff=list_diff).result)
+    assert result
+
+
+def test_compare_list_key(benchmark, document, changed_document):
+    result = benchmark(lambda: Compare(document, changed_document, list_key='sku').result)
+    assert 'sku-new' in result['rows']
+
+
+def test_compare_flatresult(benchmark, document, changed_document):
+    assert benchmark(lambda: Compare(document, changed_document).flatresult)
+
+
+def test_compare_identical(benchmark, document):
+    assert benchmark(lambda: Compare(document, document).result) is None
+
+
+def test_dict_compare(benchmark, document, changed_document):
+    assert benchmark(dict_compare, document, changed_document)
+
+
+def test_dict_compare_fingerprint_cache_hit(benchmark, document):
+    cache = FingerprintCache(ignore_private=True)
+    cache.store(document['_id'], document)
+    assert benchmark(dict_compare, document, document, fingerprint_cache=cache, doc_id=document['_id']) is None
+
+
+def test_intersect_lists(benchmark):
+    rnd = random.Random(0)
+    left = [rnd.randint(0, 20000) for _ in range(10000)]
+    right = [rnd.randint(0, 20000) for _ in range(10000)]
+    only_left, both, only_right = benchmark(Compare.intersect_lists, left, right)
+    assert len(only_left) + len(both) == len(left)
+
+
+def test_unnest(benchmark, document):
+    assert benchmark(Compare.unnest, Compare().listtodict(document))
+
+
+def mongo_rows(document):
+    return [dict(row, _id=ObjectId(), price=Decimal128(str(row['price']))) for row in document['rows']]
+
+
+def test_json_dumps_default_object(benchmark, document):
+    rows = mongo_rows(document)
+    assert benchmark(json.dumps, rows, default=default_object)
+
+
+def test_json_dumps_fast(benchmark, document):
+    rows = mongo_rows(document)
+    assert benchmark(json_dumps, rows)
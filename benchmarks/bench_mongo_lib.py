@@ -0,0 +1,58 @@
+import pytest
+
+from ijr.mongo_lib import MongoReader, MongoWriter
+
+DOCS = 5000
+
+
+def docs(count=DOCS, version=0):
+    return [{'sku': 'sku-%06d' % i, 'price': i * 0.5 + version, 'stock': i % 100, 'tags': ['a', 'b']}
+            for i in range(count)]
+
+
+def writer(client, **kwargs):
+    mw = MongoWriter('localhost', 'user', 'pass', 'db', 'col', connect=False, **kwargs)
+    mw._client.close()
+    mw._client = client
+    return mw
+
+
+def write_all(mw, documents):
+    with mw:
+        for doc in documents:
+            mw.write_data(dict(doc), doc_key=doc['sku'])
+    return mw.stats
+
+
+@pytest.mark.parametrize('options', [dict(), dict(workers=2), dict(max_bytes=4 * 1024 * 1024),
+                                     dict(adaptive=True)], ids=['sync', 'workers', 'max_bytes', 'adaptive'])
+def test_writer_batching(benchmark, mongo_client, options):
+    documents = docs()
+
+    def setup():
+        mongo_client.documents.clear()
+        return (writer(mongo_client, **options), documents), {}
+
+    stats = benchmark.pedantic(write_all, setup=setup, rounds=5)
+    assert stats.docs == DOCS
+
+
+@pytest.mark.parametrize('version', [0, 1], ids=['unchanged', 'changed'])
+def test_writer_detect_changes(benchmark, mongo_client, version):
+    write_all(writer(mongo_client), docs())
+    documents = docs(version=version)
+
+    def setup():
+        return (writer(mongo_client, detect_changes=True), documents), {}
+
+    stats = benchmark.pedantic(write_all, setup=setup, rounds=5)
+    assert stats.skipped + stats.updated == DOCS
+
+
+def test_reader_find(benchmark, mongo_client):
+    write_all(writer(mongo_client), docs())
+    reader = MongoReader('localhost', 'user', 'pass', connect=False)
+    reader._client.close()
+    reader._client = mongo_client
+    found = benchmark(lambda: sum(1 for _ in reader.find('db', 'col', {}, batch_size=1000)))
+    assert found == DOCS
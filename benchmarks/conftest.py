@@ -0,0 +1,190 @@
+"""Benchmarks for the hot paths of ijr, run against local stand-ins
+
+    pip install ijr[bench]
+    python -m pytest benchmarks/bench_*.py
+
+MongoDB, Pub/Sub and Secret Manager are in-process stand-ins, so the numbers
+measure ijr itself and not the network. Baselines recorded with
+pytest-benchmark live in benchmarks/baselines; compare a change against them with
+
+    python -m pytest benchmarks/bench_*.py --benchmark-storage=benchmarks/baselines \\
+        --benchmark-compare --benchmark-compare-fail=median:25%
+
+and record a new baseline (on the same machine) with --benchmark-save=<name>.
+Without pytest-benchmark every benchmark runs once as a plain test.
+"""
+import copy
+import json
+import random
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+
+
+class SingleRun(object):
+    """minimal stand-in for the pytest-benchmark fixture, times one call"""
+
+    def __call__(self, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        print('%s: %.6fs' % (function.__name__, time.perf_counter() - start))
+        return result
+
+    def pedantic(self, function, args=(), kwargs=None, setup=None, **_):
+        if setup is not None:
+            args, kwargs = setup()
+        return self(function, *args, **(kwargs or {}))
+
+
+try:
+    import pytest_benchmark  # noqa: F401
+except ImportError:
+    @pytest.fixture
+    def benchmark():
+        return SingleRun()
+
+
+def make_document(rows=1000, seed=0):
+    """price table like config document with nested dicts and lists of rows"""
+    rnd = random.Random(seed)
+    start = datetime(2020, 1, 1)
+    return {
+        '_id': 'prices-%d' % seed,
+        '_ts': start,
+        'name': 'prices',
+        'settings': {'currency': 'EUR', 'vat': {'high': 21, 'low': 9}, 'regions': ['nl', 'be', 'de']},
+        'rows': [{'sku': 'sku-%06d' % i,
+                  'price': round(rnd.uniform(1, 500), 2),
+                  'stock': rnd.randint(0, 1000),
+                  'valid_from': start + timedelta(days=rnd.randint(0, 365)),
+                  'tags': rnd.sample(['a', 'b', 'c', 'd', 'e', 'f'], 3),
+                  'dimensions': {'w': rnd.randint(1, 100), 'h': rnd.randint(1, 100)}}
+                 for i in range(rows)],
+    }
+
+
+def mutate(document, changes=10, seed=1):
+    """copy of document with a few prices changed, one row inserted and one deleted"""
+    rnd = random.Random(seed)
+    changed = copy.deepcopy(document)
+    rows = changed['rows']
+    for index in rnd.sample(range(len(rows)), min(changes, len(rows))):
+        rows[index]['price'] = round(rows[index]['price'] * 1.1, 2)
+    rows.insert(len(rows) // 3, dict(rows[0], sku='sku-new'))
+    del rows[2 * len(rows) // 3]
+    changed['settings']['vat']['low'] = 8
+    return changed
+
+
+class MemoryCollection(object):
+    """MongoClient, database and collection in one; applies bulk_write statements to a dict
+
+    Documents are copied shallowly, nested values are shared with the writer.
+    Supports what MongoWriter and MongoReader.find use: InsertOne, ReplaceOne,
+    UpdateOne with $set/$unset of top level or dotted fields, and find() on all
+    documents or {'_id': {'$in': [...]}}.
+    """
+    codec_options = DEFAULT_CODEC_OPTIONS
+
+    def __init__(self):
+        self.documents = dict()
+
+    def get_database(self, name, **kwargs):
+        return self
+
+    def get_collection(self, name, **kwargs):
+        return self
+
+    def close(self):
+        pass
+
+    def bulk_write(self, statements, ordered=True):
+        for statement in statements:
+            if isinstance(statement, InsertOne):
+                doc = dict(statement._doc)
+                self.documents[doc.setdefault('_id', len(self.documents))] = doc
+            elif isinstance(statement, ReplaceOne):
+                doc = dict(statement._doc)
+                self.documents[statement._filter['_id']] = dict(doc, _id=statement._filter['_id'])
+            elif isinstance(statement, UpdateOne):
+                doc = self.documents.setdefault(statement._filter['_id'], {'_id': statement._filter['_id']})
+                for path, value in statement._doc.get('$set', {}).items():
+                    *parents, field = path.split('.')
+                    target = doc
+                    for parent in parents:
+                        target = target.setdefault(parent, dict())
+                    target[field] = value
+                for path in statement._doc.get('$unset', {}):
+                    *parents, field = path.split('.')
+                    target = doc
+                    for parent in parents:
+                        target = target.get(parent, dict())
+                    target.pop(field, None)
+            else:
+                raise NotImplementedError(type(statement).__name__)
+
+    def find(self, query=None, projection=None, **kwargs):
+        if query:
+            ids = query['_id']['$in']
+            return [dict(self.documents[_id]) for _id in ids if _id in self.documents]
+        return [dict(doc) for doc in self.documents.values()]
+
+
+class FakePublisherClient(object):
+    """Pub/Sub emulator style publisher, keeps the payloads and resolves futures at once"""
+
+    def __init__(self):
+        self.published = 0
+        self.bytes = 0
+
+    def publish(self, topic, data, **attrs):
+        self.published += 1
+        self.bytes += len(data)
+        future = Future()
+        future.set_result(str(self.published))
+        return future
+
+
+class FakeSecretManagerClient(object):
+    """answers access_secret_version from a dict of secret_id -> payload"""
+
+    def __init__(self, secrets):
+        self.secrets = {secret_id: json.dumps(payload, default=str).encode()
+                        for secret_id, payload in secrets.items()}
+        self.calls = 0
+
+    def access_secret_version(self, name):
+        self.calls += 1
+        secret_id = name.split('/')[3]
+        return SimpleNamespace(payload=SimpleNamespace(data=self.secrets[secret_id]))
+
+
+@pytest.fixture(scope='session')
+def document():
+    return make_document()
+
+
+@pytest.fixture(scope='session')
+def changed_document(document):
+    return mutate(document)
+
+
+@pytest.fixture
+def mongo_client():
+    return MemoryCollection()
+
+
+@pytest.fixture
+def publisher_client():
+    return FakePublisherClient()
+
+
+@pytest.fixture
+def secret_manager(document):
+    return FakeSecretManagerClient({'MONGO': {'MDB_SERVER': 'localhost', 'MDB_USER': 'user', 'MDB_PASS': 'pass'},
+                                    'PRICES': {k: v for k, v in document.items() if not k.startswith('_')}})
@@ -0,0 +1,218 @@
+"""asyncio variants of MongoReader and MongoWriter
+
+Built on pymongo's AsyncMongoClient (pymongo >= 4.9), falling back to motor.
+
+    pip install ijr[async]
+"""
+import asyncio
+import inspect
+import time
+from datetime import datetime
+
+from pymongo import ReplaceOne, InsertOne, UpdateOne, UpdateMany
+
+from ijr.metrics_lib import get_metrics
+from ijr.mongo_lib import PipelinedWriteError, WriteStats, _client_options
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:
+    from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+
+
+async def _maybe_await(value):
+    """motor and pymongo differ in which calls return awaitables"""
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+def _connect(mdb_server, mdb_user, mdb_pass, client_kwargs):
+    # Connect with 3.4 connection-string to Atlas -> user:pwd@server....
+    return AsyncMongoClient('mongodb://%s:%s@%s' % (mdb_user, mdb_pass, mdb_server),
+                            **_client_options(**client_kwargs))
+
+
+class AsyncMongoWriter(object):
+    """An async MongoClient for bulk writing operations
+
+    Filled batches are written as tasks, up to `max_in_flight` at the same time,
+    so the event loop keeps appending while earlier batches are in transit.
+    flush() and close() wait for them and raise PipelinedWriteError for failed
+    batches.
+    """
+
+    def __init__(self, mdb_server, mdb_user, mdb_pass, db_name, col_name, threshold=250, max_in_flight=4,
+                 ordered=True, **client_kwargs):
+        """
+        :Parameters:
+         - `max_in_flight` (optional): concurrent bulk writes before appending waits
+         - `ordered` (optional): False lets the server apply a batch in parallel and
+         continue after a failing statement
+         - `client_kwargs` (optional): MongoClient options, including the pool
+         knobs `max_pool_size` and `max_idle_time_ms`
+        """
+        self.db_name = db_name
+        self.col_name = col_name
+        self._statements = list()
+        self._client = _connect(mdb_server, mdb_user, mdb_pass, client_kwargs)
+        self._threshold = threshold
+        self._write_counter = 0
+        self._ordered = ordered
+        self._max_in_flight = max_in_flight
+        self._semaphore = None
+        self._tasks = set()
+        self._errors = list()
+        self.stats = WriteStats()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.close()
+        else:
+            try:
+                await self.close()
+            except Exception:
+                # don't mask the original exception with write failures
+                pass
+
+    async def _bulk_write(self, statements):
+        try:
+            coll = self._client.get_database(self.db_name).get_collection(self.col_name)
+            metrics = get_metrics()
+            start = time.perf_counter()
+            await coll.bulk_write(statements, ordered=self._ordered)
+            latency = time.perf_counter() - start
+            self.stats.record(len(statements), 0, latency)
+            if metrics.enabled:
+                metrics.timing('mongo.bulk_write.seconds', latency, db=self.db_name, collection=self.col_name)
+                metrics.histogram('mongo.bulk_write.docs', len(statements), db=self.db_name,
+                                  collection=self.col_name)
+        except Exception as e:
+            get_metrics().count('mongo.bulk_write.errors', db=self.db_name, collection=self.col_name,
+                                error=type(e).__name__)
+            self._errors.append((e, statements))
+        finally:
+            self._semaphore.release()
+
+    async def _write_to_server(self):
+        """start a bulk write of the statements, waiting while max_in_flight writes run"""
+        if not self._statements:
+            return
+        if self._semaphore is None:
+            # created lazily so it binds to the running loop
+            self._semaphore = asyncio.Semaphore(self._max_in_flight)
+        await self._semaphore.acquire()
+        task = asyncio.ensure_future(self._bulk_write(list(self._statements)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self._statements.clear()
+        self._write_counter += 1
+
+    async def flush(self):
+        """write pending statements and wait for all bulk writes in flight"""
+        await self._write_to_server()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+        if self._errors:
+            errors, self._errors = self._errors, list()
+            raise PipelinedWriteError(errors, self._ordered)
+
+    async def close(self):
+        """write statements and disconnect from MongoDB."""
+        try:
+            await self.flush()
+        finally:
+            await _maybe_await(self._client.close())
+
+    async def _append(self, statement):
+        self._statements.append(statement)
+        if len(self._statements) > self._threshold:
+            await self._write_to_server()
+
+    async def write_data(self, doc: dict, doc_key: str = None, force_timestamp=True):
+        """write document with _ts (timestamp) included
+
+        :Parameters:
+         - `doc`: A document to be written
+         - `doc_key` (optional): Document key (_id) to be used for
+         document replacement/upsert
+        """
+        if force_timestamp:
+            doc['_ts'] = datetime.now()
+        else:
+            doc['_ts'] = doc.get('_ts', datetime.now())
+        if doc_key is not None:
+            doc['_id'] = '%s' % doc_key
+            await self._append(ReplaceOne(filter={'_id': doc['_id']},
+                                          replacement=doc,
+                                          upsert=True))
+        else:
+            await self._append(InsertOne(document=doc))
+        return self._write_counter
+
+    async def edit_data(self, query: dict, field: dict, mode: str):
+        """edit document
+
+        :Parameters:
+         - `query`: A query that matches the document to update.
+         - `field`: The modifications to apply.
+         - `mode`: Editing mode 'one' or 'many'
+        """
+        if not isinstance(query, dict):
+            raise TypeError('query must be an instance of dict')
+
+        if not isinstance(field, dict):
+            raise TypeError('field must be an instance of dict')
+
+        if not isinstance(mode, str):
+            raise TypeError('mode must be an instance of str')
+
+        modes = {"one", "many"}
+        mode = mode.lower()
+        if mode not in modes:
+            raise ValueError('Invalid mode. Expected one of: {"one", "many"}')
+
+        if mode == "one":
+            await self._append(UpdateOne(filter=query, update={'$set': field}))
+
+        elif mode == "many":
+            await self._append(UpdateMany(filter=query, update={'$set': field}))
+
+
+class AsyncMongoReader(object):
+    def __init__(self, mdb_server, mdb_user, mdb_pass, **client_kwargs):
+        self._client = _connect(mdb_server, mdb_user, mdb_pass, client_kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        await _maybe_await(self._client.close())
+
+    async def find(self, db_name, collection_name, query, sorting=None, limit=-1, projection=None):
+        db = self._client.get_database(db_name)
+        col = db.get_collection(collection_name)
+        ret = col.find(query, projection)
+        if sorting:
+            ret.sort(sorting)
+        if limit > 0:
+            ret.limit(limit)
+        async for r in ret:
+            yield r
+
+    async def aggregate(self, db_name, collection_name, pipeline):
+        db = self._client.get_database(db_name)
+        col = db.get_collection(collection_name)
+        ret = await _maybe_await(col.aggregate(pipeline, allowDiskUse=True))
+        async for r in ret:
+            yield r
+
+    async def collections(self, db_name):
+        db = self._client.get_database(db_name)
+        return await db.list_collection_names()
@@ -1,12 +1,25 @@
-"""for secret manager """
-from google.cloud import secretmanager_v1 as sm
+"""for secret manager
+
+google.cloud.secretmanager_v1, pymongo and ijr.mongo_lib are imported when first
+used, importing this module stays cheap for Cloud Function cold starts
+"""
 from types import SimpleNamespace
 from json import loads as jloads
+from copy import deepcopy
+import threading
+import time
 
-import pymongo
 from ijr.generic_lib import running_in_gcf
+from ijr.metrics_lib import get_metrics, timed
 from os import environ
-from ijr.mongo_lib import MongoReader
+
+
+def __getattr__(name):
+    # MongoReader used to be imported here at module load
+    if name == 'MongoReader':
+        from ijr.mongo_lib import MongoReader
+        return MongoReader
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
 
 
 class NestedNamespace(SimpleNamespace):
@@ -28,17 +41,207 @@ class NestedNamespace(SimpleNamespace):
                 self.__setattr__(key, value)
 
 
+_MISSING = object()
+
+
+class LazyNamespace(object):
+    """Read-through "dot" view of a dict or list, wrapping children on first access
+
+    Same access style as NestedNamespace, list items as i0, i1, ..., without
+    converting the whole payload up front. Lists and dicts also support real
+    indexing, len() and iteration:
+         ns.test_array.i0.test == ns.test_array[0].test == ns['test_array'][0]['test']
+    Wrapped children are cached, assigning an attribute writes through to the
+    wrapped dict.
+    """
+    __slots__ = ('_data', '_children')
+
+    def __init__(self, data):
+        object.__setattr__(self, '_data', data)
+        object.__setattr__(self, '_children', dict())
+
+    def _wrap(self, key, value):
+        if not isinstance(value, (dict, list)):
+            return value
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = LazyNamespace(value)
+        return child
+
+    def _list_index(self, name):
+        if isinstance(self._data, list) and name[:1] == 'i' and name[1:].isdigit():
+            index = int(name[1:])
+            if index < len(self._data):
+                return index
+        return None
+
+    def __getattr__(self, name):
+        if name in LazyNamespace.__slots__:
+            raise AttributeError(name)
+        data = self._data
+        if isinstance(data, dict):
+            if name in data:
+                return self._wrap(name, data[name])
+        else:
+            index = self._list_index(name)
+            if index is not None:
+                return self._wrap(index, data[index])
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
+
+    def __setattr__(self, name, value):
+        if not isinstance(self._data, dict):
+            raise AttributeError('list items are read only')
+        self._data[name] = value
+        self._children.pop(name, None)
+
+    def __getitem__(self, key):
+        data = self._data
+        if isinstance(data, list):
+            if isinstance(key, slice):
+                return [self._wrap(index, data[index]) for index in range(*key.indices(len(data)))]
+            if key < 0:
+                key += len(data)
+            if not 0 <= key < len(data):
+                raise IndexError('list index out of range')
+        return self._wrap(key, data[key])
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        """list items or dict keys"""
+        if isinstance(self._data, dict):
+            return iter(self._data)
+        return (self._wrap(index, value) for index, value in enumerate(self._data))
+
+    def __contains__(self, item):
+        return item in self._data
+
+    def __dir__(self):
+        if isinstance(self._data, dict):
+            return list(self._data)
+        return ['i%d' % index for index in range(len(self._data))]
+
+    def __eq__(self, other):
+        if isinstance(other, LazyNamespace):
+            return self._data == other._data
+        return NotImplemented
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self._data)
+
+    def __reduce__(self):
+        return LazyNamespace, (self._data,)
+
+    def to_dict(self):
+        """the wrapped dict or list"""
+        return self._data
+
+
+class SecretCache:
+    """In-process cache for parsed secret payloads keyed by (project, secret_id, version)
+
+    Pinned numeric versions never change and are cached permanently, aliases like
+    "latest" are cached for `ttl` seconds. With `refresh_ahead` a hit within that
+    many seconds of expiry refreshes the entry in a background thread.
+    """
+
+    def __init__(self, ttl=300, refresh_ahead=None):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self._entries = dict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def get(self, key, loader):
+        """return the cached payload for key, calling loader() when missing or expired"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                self.hits += 1
+                payload, expires = entry
+                refresh = (self.refresh_ahead is not None and expires is not None
+                           and expires - now <= self.refresh_ahead and key not in self._refreshing)
+                if refresh:
+                    self._refreshing.add(key)
+            else:
+                self.misses += 1
+                refresh = False
+                payload = _MISSING
+        get_metrics().count('cache.misses' if payload is _MISSING else 'cache.hits', cache='secrets')
+        if refresh:
+            threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+        if payload is _MISSING:
+            payload = self._store(key, loader())
+        return deepcopy(payload)
+
+    def _store(self, key, payload):
+        version = key[-1]
+        expires = None if str(version).isdigit() else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (payload, expires)
+        return payload
+
+    def _refresh(self, key, loader):
+        try:
+            self._store(key, loader())
+            with self._lock:
+                self.refreshes += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(entries=len(self._entries),
+                        hits=self.hits,
+                        misses=self.misses,
+                        refreshes=self.refreshes)
+
+
+secret_cache = SecretCache()
+
+
 class Secrets:
 
-    def __init__(self, project_id=None):
+    def __init__(self, project_id=None, cache=True):
+        """
+        :param project_id: GCP project, GCP_PROJECT env variable takes precedence
+        :param cache: use the process wide `secret_cache` (default True), False or
+         a SecretCache instance
+        """
         scraped_id = environ.get('GCP_PROJECT', project_id)
         self.project_id = scraped_id
-        if running_in_gcf():
-            self.client = sm.SecretManagerServiceClient()
-        else:
-            import logging
-            logging.warning('SecretManager -> Running local; using ./account.json')
-            self.client =sm.SecretManagerServiceClient.from_service_account_json('account.json')
+        if cache is True:
+            cache = secret_cache
+        self.cache = cache or None
+        self._client = None
+
+    @property
+    def client(self):
+        """SecretManagerServiceClient, created on first access so cache hits skip it"""
+        if self._client is None:
+            from google.cloud import secretmanager_v1 as sm
+            if running_in_gcf():
+                self._client = sm.SecretManagerServiceClient()
+            else:
+                import logging
+                logging.warning('SecretManager -> Running local; using ./account.json')
+                self._client = sm.SecretManagerServiceClient.from_service_account_json('account.json')
+        return self._client
+
+    @client.setter
+    def client(self, value):
+        self._client = value
 
     def dict_secret(self, secret_id, version_id=None):
         """
@@ -47,23 +250,185 @@ class Secrets:
         """
         if version_id is None:
             version_id = "latest"
-            # Build the resource name of the secret version.
+        if self.cache is None:
+            return self._access_secret(secret_id, version_id)
+        return self.cache.get((self.project_id, secret_id, str(version_id)),
+                              lambda: self._access_secret(secret_id, version_id))
+
+    def _access_secret(self, secret_id, version_id):
+        # Build the resource name of the secret version.
         name = f"projects/{self.project_id}/secrets/{secret_id}/versions/{version_id}"
-        secret = self.client.access_secret_version(name=name)
+        with timed('secrets.access.seconds', secret=secret_id):
+            secret = self.client.access_secret_version(name=name)
         _payload = secret.payload.data.decode('UTF-8')
         payload = jloads(_payload)
         return payload
 
-    def dot_secret(self, secret_id, version_id=None):
+    def dot_secret(self, secret_id, version_id=None, lazy=False):
         """
           Access the payload for the given secret version if one exists. The version
           can be a version number as a string (e.g. "5") or an alias (e.g. "latest").
-          Returns a namespace for "dot" access
+          Returns a namespace for "dot" access, a LazyNamespace when lazy is True
           """
 
-        payload = self.dict_secret(secret_id, version_id=None)
+        payload = self.dict_secret(secret_id, version_id=version_id)
         if payload:
-            return NestedNamespace(payload)
+            return LazyNamespace(payload) if lazy else NestedNamespace(payload)
+
+
+class ConfigCache:
+    """Process wide cache for config documents keyed by (server, db, collection, _id)
+
+    :Parameters:
+     - `mode`: 'ttl' expires entries after `ttl` seconds, 'watch' keeps entries
+     until a change stream on the collection reports a change to their _id and
+     'poll' does the same by polling the collection for a newer _ts every
+     `poll_interval` seconds. 'watch' falls back to 'poll' when change streams
+     are not available (e.g. standalone servers). Polling does not see deletes
+     or documents written without _ts.
+     - `ttl` (optional): entry lifetime in seconds for mode 'ttl'
+     - `poll_interval` (optional): seconds between polls for mode 'poll'
+    """
+    MODES = {'ttl', 'watch', 'poll'}
+    WATCHER_START_TIMEOUT = 5
+
+    def __init__(self, mode='ttl', ttl=300, poll_interval=30):
+        if mode not in self.MODES:
+            raise ValueError('Invalid mode. Expected one of: {"ttl", "watch", "poll"}')
+        self.mode = mode
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self._entries = dict()
+        self._watchers = dict()
+        # key -> [loads in progress, invalidations since the first of them started]
+        self._loading = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, mongo, db_name, collection_name, _id, loader):
+        """return the cached config document, calling loader() when missing or expired
+
+        :Parameters:
+         - `mongo`: namespace with MDB_SERVER, MDB_USER and MDB_PASS
+         - `loader`: callable returning the document from the server
+        """
+        key = (mongo.MDB_SERVER, db_name, collection_name, _id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                self.hits += 1
+                get_metrics().count('cache.hits', cache='configs')
+                return deepcopy(entry[0])
+            self.misses += 1
+            loading = self._loading.setdefault(key, [0, 0])
+            loading[0] += 1
+            invalidations = loading[1]
+        get_metrics().count('cache.misses', cache='configs')
+        stored = False
+        try:
+            if self.mode != 'ttl':
+                self._watch(mongo, db_name, collection_name)
+            doc = loader()
+            stored = True
+        finally:
+            with self._lock:
+                loading[0] -= 1
+                if not loading[0]:
+                    del self._loading[key]
+                # a change reported during the load may not be in doc, don't cache it
+                if stored and loading[1] == invalidations:
+                    expires = now + self.ttl if self.mode == 'ttl' else None
+                    self._entries[key] = (doc, expires)
+        return deepcopy(doc)
+
+    def invalidate(self, mdb_server, db_name, collection_name, _id=None):
+        """drop one cached document, or all documents of the collection if _id is None"""
+        with self._lock:
+            if _id is not None:
+                keys = [(mdb_server, db_name, collection_name, _id)]
+            else:
+                keys = [k for k in set(self._entries) | set(self._loading)
+                        if k[:3] == (mdb_server, db_name, collection_name)]
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+                if key in self._loading:
+                    self._loading[key][1] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(entries=len(self._entries),
+                        hits=self.hits,
+                        misses=self.misses,
+                        invalidations=self.invalidations,
+                        watchers=len(self._watchers))
+
+    def _watch(self, mongo, db_name, collection_name):
+        """start one background watcher per collection"""
+        target = (mongo.MDB_SERVER, db_name, collection_name)
+        with self._lock:
+            if target in self._watchers:
+                return
+            ready = threading.Event()
+            thread = threading.Thread(target=self._run_watcher,
+                                      args=(mongo.MDB_SERVER, mongo.MDB_USER, mongo.MDB_PASS,
+                                            db_name, collection_name, ready),
+                                      daemon=True)
+            self._watchers[target] = thread
+        thread.start()
+        # don't load documents before the watcher can see changes to them
+        ready.wait(self.WATCHER_START_TIMEOUT)
+
+    def _run_watcher(self, mdb_server, mdb_user, mdb_pass, db_name, collection_name, ready):
+        import logging
+        import pymongo.errors
+        from ijr.mongo_lib import client_registry
+        client = client_registry.acquire(mdb_server, mdb_user, mdb_pass)
+        col = client.get_database(db_name).get_collection(collection_name)
+        try:
+            if self.mode == 'watch':
+                try:
+                    with col.watch() as stream:
+                        ready.set()
+                        for change in stream:
+                            self.invalidate(mdb_server, db_name, collection_name,
+                                            change.get('documentKey', {}).get('_id'))
+                except pymongo.errors.PyMongoError as e:
+                    logging.warning('ConfigCache -> change stream unavailable (%s); polling _ts', e)
+                    self.invalidate(mdb_server, db_name, collection_name)
+            self._poll(col, mdb_server, db_name, collection_name, ready)
+        except Exception:
+            logging.exception('ConfigCache -> watcher for %s.%s stopped', db_name, collection_name)
+            # entries can no longer be trusted, fall back to loading from the server
+            with self._lock:
+                self._watchers.pop((mdb_server, db_name, collection_name), None)
+            self.invalidate(mdb_server, db_name, collection_name)
+        finally:
+            ready.set()
+            client_registry.release(client)
+
+    def _poll(self, col, mdb_server, db_name, collection_name, ready):
+        latest = col.find_one({'_ts': {'$exists': True}}, {'_ts': 1}, sort=[('_ts', -1)])
+        last_ts = latest['_ts'] if latest else None
+        ready.set()
+        while True:
+            time.sleep(self.poll_interval)
+            query = {'_ts': {'$gt': last_ts}} if last_ts is not None else {'_ts': {'$exists': True}}
+            for doc in col.find(query, {'_ts': 1}):
+                self.invalidate(mdb_server, db_name, collection_name, doc['_id'])
+                if last_ts is None or doc['_ts'] > last_ts:
+                    last_ts = doc['_ts']
+
+
+config_cache = ConfigCache()
 
 
 class Config:
@@ -72,12 +437,19 @@ class Config:
     DEFAULT_COLLECTION_NAME = "configs"
     DEFAULT_SECRET_TARGET = "MONGO"
 
-    def __init__(self, project_id=None, secret_target=None, secret_id=None):
+    def __init__(self, project_id=None, secret_target=None, secret_id=None, cache=True):
+        """
+        :param cache: cache config documents in the process wide `config_cache`
+         (default True), False to always read from MongoDB or a ConfigCache instance
+        """
         if secret_id is None:
             secret_id = self._get_secret_id_from_env_var(secret_target)
         self._function_name = environ.get('FUNCTION_NAME')
         secrets = Secrets(project_id)
         self.mongo = secrets.dot_secret(secret_id)
+        if cache is True:
+            cache = config_cache
+        self.cache = cache or None
 
     def _get_secret_id_from_env_var(self, secret_target=None):
         if secret_target is None:
@@ -92,18 +464,28 @@ class Config:
             db_name = self.DEFAULT_DB_NAME
         if collection_name is None:
             collection_name = self.DEFAULT_COLLECTION_NAME
-        with MongoReader(mdb_server=self.mongo.MDB_SERVER,
-                         mdb_user=self.mongo.MDB_USER,
-                         mdb_pass=self.mongo.MDB_PASS) as mr_configs:
-            doc = next(mr_configs.find(db_name=db_name,
-                                       collection_name=collection_name,
-                                       query={"_id": _id}), None)
+        if self.cache is None:
+            return self._find_config(_id, db_name, collection_name)
+        return self.cache.get(self.mongo, db_name, collection_name, _id,
+                              lambda: self._find_config(_id, db_name, collection_name))
+
+    def _find_config(self, _id, db_name, collection_name):
+        from ijr.mongo_lib import MongoReader
+        with timed('config.find.seconds', db=db_name, collection=collection_name):
+            with MongoReader(mdb_server=self.mongo.MDB_SERVER,
+                             mdb_user=self.mongo.MDB_USER,
+                             mdb_pass=self.mongo.MDB_PASS,
+                             pooled=True) as mr_configs:
+                doc = next(mr_configs.find(db_name=db_name,
+                                           collection_name=collection_name,
+                                           query={"_id": _id}), None)
         return doc
 
-    def get_configs_dot(self, _id=None, db_name=None, collection_name=None):
+    def get_configs_dot(self, _id=None, db_name=None, collection_name=None, lazy=False):
+        """config document for "dot" access, a LazyNamespace when lazy is True"""
         temp = self.get_configs_dict(_id=_id,
                                      db_name=db_name,
                                      collection_name=collection_name)
         if temp:
-            return NestedNamespace(temp)
+            return LazyNamespace(temp) if lazy else NestedNamespace(temp)
         return None
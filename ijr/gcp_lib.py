@@ -1,30 +1,239 @@
+import base64
+import gzip
 import json
+import threading
+import time
 
-from google.cloud import pubsub
+from ijr.generic_lib import running_in_gcf, default_object, json_dumps
+from ijr.metrics_lib import get_metrics
 
-from ijr.generic_lib import running_in_gcf, default_object
+
+def __getattr__(name):
+    # google.cloud.pubsub is imported by the first PubSubPublisher, not at module load
+    if name == 'pubsub':
+        from google.cloud import pubsub
+        return pubsub
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+
+def _publisher_client():
+    from google.cloud import pubsub
+    if running_in_gcf():
+        return pubsub.PublisherClient()
+    import logging
+    logging.warning('PubSubPublisher -> Running local; using ./account.json')
+    return pubsub.PublisherClient.from_service_account_json('account.json')
+
+
+class PublishError(Exception):
+    """One or more batches failed to publish
+
+    `failures` is a list of (exception, messages) tuples, one per failed batch
+    """
+
+    def __init__(self, failures):
+        super().__init__('%d batch(es) failed to publish' % len(failures))
+        self.failures = failures
+
+
+class JsonEncoder(object):
+    """stdlib json, the envelope is identical to json.dumps(dict(_type=..., data=[...]), sort_keys=True)"""
+    content_type = 'application/json'
+    separator = b', '
+
+    def __init__(self, default=None):
+        self._default = default or default_object
+
+    def encode(self, obj):
+        # ensure_ascii keeps the str length equal to the utf-8 byte size
+        return json.dumps(obj, sort_keys=True, default=self._default).encode()
+
+    def head(self, msg_type, count):
+        return b'{"_type": ' + self.encode(msg_type) + b', "data": ['
+
+    def tail(self):
+        return b']}'
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class OrjsonEncoder(JsonEncoder):
+    """orjson, compact separators; values orjson rejects, like integers beyond 64 bit,
+    are encoded by json"""
+    separator = b','
+
+    def __init__(self, default=None):
+        import orjson
+        super().__init__(default)
+        self._orjson = orjson
+
+    def encode(self, obj):
+        return json_dumps(obj, sort_keys=True, default=self._default, as_bytes=True)
+
+    def head(self, msg_type, count):
+        return b'{"_type":' + self.encode(msg_type) + b',"data":['
+
+    def decode(self, data):
+        return self._orjson.loads(data)
+
+
+class MsgpackEncoder(object):
+    """msgpack, the envelope is a map {_type, data} with the packed messages concatenated in an array"""
+    content_type = 'application/msgpack'
+    separator = b''
+
+    def __init__(self, default=None):
+        import msgpack
+        self._msgpack = msgpack
+        self._default = default or default_object
+
+    def encode(self, obj):
+        return self._msgpack.packb(obj, default=self._default)
+
+    def head(self, msg_type, count):
+        packer = self._msgpack.Packer(default=self._default)
+        return (packer.pack_map_header(2) + packer.pack('_type') + packer.pack(msg_type)
+                + packer.pack('data') + packer.pack_array_header(count))
+
+    def tail(self):
+        return b''
+
+    def decode(self, data):
+        return self._msgpack.unpackb(data, raw=False)
+
+
+def _orjson_or_json(default=None):
+    try:
+        return OrjsonEncoder(default)
+    except ImportError:
+        return JsonEncoder(default)
+
+
+ENCODERS = {'json': JsonEncoder,
+            'orjson': OrjsonEncoder,
+            'msgpack': MsgpackEncoder,
+            'auto': _orjson_or_json}
+ENCODERS_BY_CONTENT_TYPE = {'application/json': JsonEncoder,
+                            'application/msgpack': MsgpackEncoder}
+
+
+def _gzip():
+    return gzip.compress, gzip.decompress
+
+
+def _zstd():
+    import zstandard
+    # a compressor per call, the instances aren't safe to share between threads
+    return (lambda data: zstandard.ZstdCompressor().compress(data),
+            lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+# (compress, decompress) factories; they raise ImportError when the codec isn't installed
+COMPRESSIONS = {'gzip': _gzip,
+                'zstd': _zstd}
+
+
+def decode_message(data, attributes=None):
+    """Unpack an envelope published by PubSubPublisher -> dict(_type=..., data=[...])
+
+    :param data: message payload; bytes, a base64 str (Cloud Function event['data'])
+     or a pubsub message with data and attributes
+    :param attributes: message attributes, content_type and content_encoding select
+     the decoder and decompression (default plain json)
+    """
+    if hasattr(data, 'data'):
+        attributes = data.attributes if attributes is None else attributes
+        data = data.data
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    attributes = attributes or {}
+    content_encoding = attributes.get('content_encoding')
+    if content_encoding:
+        if content_encoding not in COMPRESSIONS:
+            raise ValueError('Unknown content_encoding %s' % content_encoding)
+        data = COMPRESSIONS[content_encoding]()[1](data)
+    content_type = attributes.get('content_type', JsonEncoder.content_type)
+    if content_type not in ENCODERS_BY_CONTENT_TYPE:
+        raise ValueError('Unknown content_type %s' % content_type)
+    return ENCODERS_BY_CONTENT_TYPE[content_type]().decode(data)
 
 
 class PubSubPublisher(object):
+    # Pub/Sub rejects publish requests over 10 MB, keep room for the request framing
+    MAX_REQUEST_BYTES = 10 * 1000 * 1000 - 16 * 1024
+
+    def __init__(self, topic, msg_type='Generic', threshold=25, blocking=True,
+                 max_outstanding_messages=1000, max_outstanding_bytes=100 * 1024 * 1024,
+                 max_bytes=None, max_latency=None, encoder='json', compression=None, serializer=None,
+                 **kwargs):
+        """
+        :param threshold: publish once more than threshold messages are pending
+        :param max_bytes: publish before the envelope would grow beyond max_bytes,
+         defaults to the Pub/Sub request limit minus the message attributes
+        :param max_latency: publish pending messages at most max_latency seconds
+         after the first one was added (default None, wait for the threshold)
+        :param blocking: wait for every batch to be published (default True). When
+         False batches stay in flight while publish() returns; flush() and __exit__
+         wait for them and raise PublishError for failed batches
+        :param max_outstanding_messages: with blocking=False, the number of messages
+         in flight before publishing waits for earlier batches
+        :param max_outstanding_bytes: with blocking=False, the payload bytes in flight
+         before publishing waits for earlier batches
+        :param encoder: 'json' (default), 'orjson', 'msgpack' or 'auto' (orjson when
+         installed, else json)
+        :param compression: None (default), 'gzip' or 'zstd' (needs zstandard)
+        :param serializer: handler for values the encoder can't encode, default the
+         generic_lib `serializer` registry (datetimes, Decimal, UUID, ObjectId, sets, bytes, ...)
+        :param kwargs: message attributes
 
-    def __init__(self, topic, msg_type='Generic', threshold=25, **kwargs):
+        Non default encoders and compression are signalled through the content_type and
+        content_encoding attributes, subscribers unpack with decode_message()
+        """
         self._messages = list()
+        self._encoded = list()
+        self._size = 0
         self._topic = topic
         self.msg_type = msg_type
         self._msg_kwargs = {k: str(v) for k, v in kwargs.items()}  # cast values to string for passing to pub/sub
+        if encoder not in ENCODERS:
+            raise ValueError('Invalid encoder. Expected one of: {"json", "orjson", "msgpack", "auto"}')
+        self._encoder = ENCODERS[encoder](serializer)
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError('Invalid compression. Expected one of: {None, "gzip", "zstd"}')
+        # imports the codec now, not at the first flush
+        self._compress = COMPRESSIONS[compression]()[0] if compression else None
+        if self._encoder.content_type != JsonEncoder.content_type:
+            self._msg_kwargs['content_type'] = self._encoder.content_type
+        if compression:
+            self._msg_kwargs['content_encoding'] = compression
         self._threshold = threshold
-        if running_in_gcf():
-            self._client = pubsub.PublisherClient()
-        else:
-            import logging
-            logging.warning('PubSubPublisher -> Running local; using ./account.json')
-            self._client = pubsub.PublisherClient.from_service_account_json('account.json')
+        if max_bytes is None:
+            max_bytes = self.MAX_REQUEST_BYTES - sum(len(k.encode()) + len(v.encode())
+                                                     for k, v in self._msg_kwargs.items())
+        self._max_bytes = max_bytes
+        self._max_latency = max_latency
+        self._timer = None
+        self._lock = threading.RLock()
+        self._blocking = blocking
+        self._max_outstanding_messages = max_outstanding_messages
+        self._max_outstanding_bytes = max_outstanding_bytes
+        self._outstanding_messages = 0
+        self._outstanding_bytes = 0
+        self._outstanding = threading.Condition()
+        self.failures = list()
+        self._client = _publisher_client()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._publish_messages()
+        if exc_type is None:
+            self.flush()
+        else:
+            # don't mask the original exception with publish failures
+            self._publish_messages()
+            self._wait_outstanding()
 
     @property
     def msg_type(self):
@@ -36,19 +245,121 @@ class PubSubPublisher(object):
             raise Exception("msg_type can't be None")
         self.__msg_type = prop_value
 
+    def _envelope_size(self, count, size):
+        """bytes of an envelope with count messages of size bytes in total"""
+        encoder = self._encoder
+        return (len(encoder.head(self.msg_type, count)) + len(encoder.tail()) + size
+                + len(encoder.separator) * max(count - 1, 0))
+
     def _publish_messages(self):
-        if not self._messages:
-            return
-        msg_dict = dict(_type=self.msg_type,
-                        data=self._messages)
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._messages:
+                return
+            encoder = self._encoder
+            data = (encoder.head(self.msg_type, len(self._encoded)) + encoder.separator.join(self._encoded)
+                    + encoder.tail())
+            if self._compress is not None:
+                data = self._compress(data)
+            messages = list(self._messages)
+            self._messages.clear()
+            self._encoded.clear()
+            self._size = 0
+            metrics = get_metrics()
+            if metrics.enabled:
+                metrics.histogram('pubsub.publish.messages', len(messages), topic=self._topic)
+                metrics.histogram('pubsub.publish.bytes', len(data), topic=self._topic)
+            if self._blocking:
+                with metrics.span('pubsub.publish.seconds', topic=self._topic):
+                    ret = self._client.publish(self._topic, data, **self._msg_kwargs).result()
+            else:
+                ret = self._publish_async(data, messages)
+            return ret
+
+    def _publish_async(self, data, messages):
+        """publish without waiting, bounded by the max outstanding messages/bytes"""
+        size = len(data)
+        with self._outstanding:
+            while self._outstanding_messages and (
+                    self._outstanding_messages + len(messages) > self._max_outstanding_messages
+                    or self._outstanding_bytes + size > self._max_outstanding_bytes):
+                self._outstanding.wait()
+            self._outstanding_messages += len(messages)
+            self._outstanding_bytes += size
+
+        metrics = get_metrics()
+        start = time.perf_counter()
 
-        msg = json.dumps(msg_dict, sort_keys=True, default=default_object)
-        ret = self._client.publish(self._topic, msg.encode(), **self._msg_kwargs).result()
+        def done(future):
+            try:
+                future.result()
+                metrics.timing('pubsub.publish.seconds', time.perf_counter() - start, topic=self._topic)
+            except Exception as e:
+                metrics.count('pubsub.publish.errors', topic=self._topic, error=type(e).__name__)
+                with self._outstanding:
+                    self.failures.append((e, messages))
+            finally:
+                with self._outstanding:
+                    self._outstanding_messages -= len(messages)
+                    self._outstanding_bytes -= size
+                    self._outstanding.notify_all()
 
-        self._messages.clear()
-        return ret
+        try:
+            future = self._client.publish(self._topic, data, **self._msg_kwargs)
+        except Exception:
+            with self._outstanding:
+                self._outstanding_messages -= len(messages)
+                self._outstanding_bytes -= size
+                self._outstanding.notify_all()
+            raise
+        future.add_done_callback(done)
+        return future
+
+    def _wait_outstanding(self):
+        with self._outstanding:
+            while self._outstanding_messages:
+                self._outstanding.wait()
+
+    def flush(self):
+        """publish pending messages and wait for all batches in flight
+
+        raises PublishError with the failed batches since the previous flush
+        """
+        self._publish_messages()
+        self._wait_outstanding()
+        with self._outstanding:
+            failures, self.failures = self.failures, list()
+        if failures:
+            raise PublishError(failures)
+
+    def _publish_timed(self):
+        """max_latency timer; failures are reported by the next flush()"""
+        with self._lock:
+            batch = list(self._messages)
+            try:
+                self._publish_messages()
+            except Exception as e:
+                with self._outstanding:
+                    self.failures.append((e, batch))
 
     def publish(self, msg):
-        self._messages.append(msg)
-        if len(self._messages) > self._threshold:
-            self._publish_messages()
+        # max_bytes applies to the uncompressed envelope
+        encoded = self._encoder.encode(msg)
+        with self._lock:
+            count = len(self._encoded) + 1
+            if self._encoded and self._envelope_size(count, self._size + len(encoded)) > self._max_bytes:
+                self._publish_messages()
+                count = 1
+            if count == 1 and self._envelope_size(1, len(encoded)) > self._max_bytes:
+                raise ValueError('message of %d bytes exceeds max_bytes %d' % (len(encoded), self._max_bytes))
+            self._messages.append(msg)
+            self._encoded.append(encoded)
+            self._size += len(encoded)
+            if len(self._messages) > self._threshold:
+                self._publish_messages()
+            elif self._max_latency is not None and self._timer is None:
+                self._timer = threading.Timer(self._max_latency, self._publish_timed)
+                self._timer.daemon = True
+                self._timer.start()
@@ -1,12 +1,29 @@
+import base64
 import datetime
+import decimal
+import hashlib
+import json
 import os
-from itertools import chain, starmap
+import uuid
+from collections import Counter, OrderedDict
+from difflib import SequenceMatcher
+from operator import methodcaller
 
 
-def dict_compare(old_dict, new_dict, nested=None):
+def dict_compare(old_dict, new_dict, nested=None, fingerprint_cache=None, doc_id=None):
     """ Compare two dictionaries
         Only 1 level, ignoring attributes starting with '_'
+
+        With a FingerprintCache(ignore_private=True) and the document id only the top
+        level keys changed since the cached version of the document are compared.
     """
+    if fingerprint_cache is not None and doc_id is not None:
+        changed = fingerprint_cache.changed_keys(doc_id, new_dict)
+        if changed is not None:
+            if not changed:
+                return
+            old_dict = {k: v for k, v in old_dict.items() if k in changed}
+            new_dict = {k: v for k, v in new_dict.items() if k in changed}
     key_prefix = nested + '|' if nested else ''
     intersect_keys = old_dict.keys() & new_dict.keys()
     modified = {key_prefix + k: dict(old=old_dict[k], new=new_dict[k], action='mod') for k in intersect_keys
@@ -35,11 +52,170 @@ def running_in_gcf():
     return os.getenv('GCP_PROJECT') is not None
 
 
-def default_object(o):
-    """ Default handler for json.dumps()"""
-    if isinstance(o, (datetime.date, datetime.datetime)):
-        return o.isoformat()
-    raise TypeError("Type %s not serializable" % type(o))
+def _sorted_list(values):
+    try:
+        return sorted(values)
+    except TypeError:
+        return list(values)
+
+
+def _base64(value):
+    return base64.b64encode(value).decode('ascii')
+
+
+class Serializer(object):
+    """Type dispatch `default` handler for json.dumps(), orjson and msgpack
+
+    Handlers are registered per type, or per qualified type name for types of
+    optional packages (no import needed). A value is handled by the handler of
+    the first type in its MRO that has one; the result of that search is
+    cached per type, so each call costs one dict lookup.
+
+        serializer.register(Money, lambda m: str(m.amount))
+
+        @serializer.register('bson.timestamp.Timestamp')
+        def timestamp(ts):
+            return ts.as_datetime().isoformat()
+    """
+
+    def __init__(self, handlers=None):
+        self._handlers = dict()
+        self._cache = dict()
+        for cls, handler in (handlers or dict()).items():
+            self.register(cls, handler)
+
+    def register(self, cls, handler=None):
+        """register handler for cls, a type or a qualified name like 'bson.objectid.ObjectId'
+
+        Without handler returns a decorator.
+        """
+        if handler is None:
+            def decorator(function):
+                self.register(cls, function)
+                return function
+            return decorator
+        if not isinstance(cls, str):
+            cls = f'{cls.__module__}.{cls.__qualname__}'
+        self._handlers[cls] = handler
+        self._cache = dict()
+        return handler
+
+    def handler(self, cls):
+        """handler for values of type cls, None if there is none"""
+        try:
+            return self._cache[cls]
+        except KeyError:
+            pass
+        handler = None
+        for base in cls.__mro__:
+            handler = self._handlers.get(f'{base.__module__}.{base.__qualname__}')
+            if handler is not None:
+                break
+        self._cache[cls] = handler
+        return handler
+
+    def copy(self):
+        serializer = Serializer()
+        serializer._handlers = dict(self._handlers)
+        return serializer
+
+    def default(self, o):
+        """the `default` handler; pass the bound method, it is called faster than the instance"""
+        try:
+            handler = self._cache[type(o)]
+        except KeyError:
+            handler = self.handler(type(o))
+        if handler is None:
+            raise TypeError("Type %s not serializable" % type(o))
+        return handler(o)
+
+    __call__ = default
+
+
+serializer = Serializer({
+    datetime.date: methodcaller('isoformat'),
+    datetime.time: methodcaller('isoformat'),
+    decimal.Decimal: str,
+    uuid.UUID: str,
+    set: _sorted_list,
+    frozenset: _sorted_list,
+    bytes: _base64,
+    bytearray: _base64,
+    'collections.abc.Mapping': dict,
+    'bson.objectid.ObjectId': str,
+    'bson.decimal128.Decimal128': str,
+})
+
+# Default handler for json.dumps()
+default_object = serializer.default
+
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+
+def json_dumps(obj, sort_keys=False, default=None, as_bytes=False):
+    """JSON str of obj (utf-8 bytes with as_bytes), with orjson when installed
+
+    Compact separators; types json can't encode go through `default` (default
+    the `serializer` registry). orjson formats datetimes, dates, times and
+    UUIDs itself, in the same ISO format. Falls back to json for values orjson
+    rejects, like integers beyond 64 bit.
+    """
+    default = default or serializer.default
+    if _orjson is not None:
+        option = _orjson.OPT_NON_STR_KEYS | (_orjson.OPT_SORT_KEYS if sort_keys else 0)
+        try:
+            encoded = _orjson.dumps(obj, default=default, option=option)
+            return encoded if as_bytes else encoded.decode()
+        except TypeError:
+            pass
+    encoded = json.dumps(obj, sort_keys=sort_keys, default=default, separators=(',', ':'), ensure_ascii=False)
+    return encoded.encode() if as_bytes else encoded
+
+
+_MISSING = object()
+
+
+def _identity(value):
+    return value
+
+
+_DICT = object()
+_LIST = object()
+
+
+class _Unhashable(object):
+    """hash key for values that can't be frozen; they share one bucket and compare with =="""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __hash__(self):
+        return 0
+
+    def __eq__(self, other):
+        return isinstance(other, _Unhashable) and self.value == other.value
+
+
+def _freeze(value):
+    """Hashable canonical key for value; equal values (==) give equal keys"""
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        pass
+    if isinstance(value, dict):
+        return _DICT, frozenset((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return _LIST, tuple(_freeze(v) for v in value)
+    if isinstance(value, tuple):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return _Unhashable(value)
 
 
 # def buid_dict(composed_key, key_value):
@@ -70,20 +246,55 @@ def default_object(o):
 #     return new_dict
 
 class Compare(object):
+    """Deep compare two dictionaries
+
+    Lists are compared by index unless
+     - `list_key` is set: lists of dictionaries that all have a unique list_key
+     value are matched on that value, the list result is keyed by str(value)
+     - `list_diff` is 'sequence': lists are aligned with a longest matching
+     subsequence diff, so an insert or delete only reports that element. Added
+     and modified elements are keyed by their index in the new list, deleted
+     elements by '~' and their index in the old list
+    Lists that don't qualify for list_key fall back to list_diff.
 
-    def __init__(self, old_dictionary=None, new_dictionary=None, ignore_starting=None, ignore_ending=None):
+    With a `fingerprint_cache` and `doc_id` only the top level keys changed since
+    the cached version of the document (which must be old_dictionary) are compared.
+    """
+    LIST_DIFFS = {'index', 'sequence'}
+
+    def __init__(self, old_dictionary=None, new_dictionary=None, ignore_starting=None, ignore_ending=None,
+                 list_key=None, list_diff='index', fingerprint_cache=None, doc_id=None):
+        if list_diff not in self.LIST_DIFFS:
+            raise ValueError('Invalid list_diff. Expected one of: {"index", "sequence"}')
         self.old_dict = old_dictionary
         self.new_dict = new_dictionary
         self.ignore_starting = ignore_starting
         self.ignore_ending = ignore_ending
-        self.result = self.deepcompare(old_dict=old_dictionary,
-                                       new_dict=new_dictionary,
-                                       ignore_starting=self.ignore_starting,
-                                       ignore_ending=self.ignore_starting)
-        self.flatresult = self.flat()
+        self.list_key = list_key
+        self.list_diff = list_diff
+        self._result = _MISSING
+        self._flatresult = _MISSING
+        self._only_keys = None
+        if fingerprint_cache is not None and doc_id is not None:
+            self._only_keys = fingerprint_cache.changed_keys(doc_id, new_dictionary)
+
+    @property
+    def result(self):
+        """nested differences, computed on first access"""
+        if self._result is _MISSING:
+            self._result = self._build_result(self._walk(self.old_dict, self.new_dict, 'value',
+                                                         self.ignore_starting, self.ignore_ending, self._only_keys))
+        return self._result
+
+    @property
+    def flatresult(self):
+        """unnested result, computed on first access"""
+        if self._flatresult is _MISSING:
+            self._flatresult = self.flat()
+        return self._flatresult
 
     @staticmethod
-    def intersect_lists(left_list, right_list):
+    def intersect_lists(left_list, right_list, multiset=False):
         """Intersect two list and return difference as tuple (left, middle, right)
 
         USAGE:  
@@ -104,10 +315,43 @@ class Compare(object):
             l = [1]
             m = [2, 3]
             r = [4]
+
+        Values keep their order and duplicates; a value matches if an equal value is
+        anywhere in the other list. With multiset=True every value matches at most
+        one equal value in the other list:
+            l, m, r = intersect_list([1, 1, 2], [1, 3], multiset=True)
+            l = [1, 2]
+            m = [1]
+            r = [3]
+
+        Values are matched on a hash, dicts and lists on a canonical fingerprint, so
+        this runs in linear time.
         """
-        l = [value for value in left_list if value not in right_list]
-        m = [value for value in left_list if value in right_list]
-        r = [value for value in right_list if value not in left_list]
+        left_keys = [_freeze(value) for value in left_list]
+        right_keys = [_freeze(value) for value in right_list]
+        if multiset:
+            right_counts = Counter(right_keys)
+            left_counts = Counter()
+            l, m = list(), list()
+            for key, value in zip(left_keys, left_list):
+                if right_counts[key] > 0:
+                    right_counts[key] -= 1
+                    left_counts[key] += 1
+                    m.append(value)
+                else:
+                    l.append(value)
+            r = list()
+            for key, value in zip(right_keys, right_list):
+                if left_counts[key] > 0:
+                    left_counts[key] -= 1
+                else:
+                    r.append(value)
+            return l, m, r
+        right_set = set(right_keys)
+        left_set = set(left_keys)
+        l = [value for key, value in zip(left_keys, left_list) if key not in right_set]
+        m = [value for key, value in zip(left_keys, left_list) if key in right_set]
+        r = [value for key, value in zip(right_keys, right_list) if key not in left_set]
         return l, m, r
 
     @staticmethod
@@ -120,24 +364,24 @@ class Compare(object):
             returns {'a.b.c.d': ['e', 'f'], 'a.b.c.g': 5}
         """
 
-        def unpack(parent_key, parent_value):
-            """Unpack one level of nesting in a dictionary"""
-            try:
-                for key, value in parent_value.items():
-                    yield (f'{parent_key}{separator}{key}', value)
-            except AttributeError:
-                # parent_value was not a dict, no need to flatten
-                yield (f'{parent_key}', parent_value)
-
         if not isinstance(dictionary, dict):
             return dictionary
-        while any(isinstance(value, dict) for value in dictionary.values()): # TODO secure breaking
-            # Keep unpacking the dictionary until all value's are not dictionary's
-            try:
-                dictionary = dict(chain.from_iterable(starmap(unpack, dictionary.items())))
-            except AttributeError:
-                break
-        return dictionary
+        if not any(isinstance(value, dict) for value in dictionary.values()):
+            return dictionary
+        # one depth first pass; keys are joined as strings like the per level unpacking did
+        result = {}
+        stack = [(None, iter(dictionary.items()))]
+        while stack:
+            prefix, items = stack[-1]
+            for key, value in items:
+                key = f'{key}' if prefix is None else f'{prefix}{separator}{key}'
+                if isinstance(value, dict):
+                    stack.append((key, iter(value.items())))
+                    break
+                result[key] = value
+            else:
+                stack.pop()
+        return result
 
     @staticmethod
     def exclude_keys(set_of_keys, starting=None, ending=None):
@@ -182,47 +426,324 @@ class Compare(object):
         :param new_dict: the dictionary to compare 
         :param ignore_starting: keys to be ignored starting with string (default None)
         :param ignore_ending: keys to be ignored ending with string (default None)
-        :param unnested_result: boolean if return unnest(normalized) result
-        :param separator: if unnested_result separator used to normalize keys
         """
-        if old_dict == new_dict:
+        return self._build_result(self._walk(old_dict, new_dict, 'value', ignore_starting, ignore_ending))
+
+    def comparelists(self, old_list, new_list):
+        """Compare two lists by list_key or sequence alignment, see Compare"""
+        if not self._matched_lists(old_list, new_list):
+            return self.deepcompare(self.listtodict(old_list), self.listtodict(new_list))
+        return self._build_result(self._walk(old_list, new_list, 'list'))
+
+    def changes(self):
+        """Yield the changes between old_dict and new_dict as flat records
+
+        (path, action, old, new): path is a tuple of keys (list positions as str),
+        action is 'add', 'del' or 'mod', old is None for 'add' and new for 'del'.
+        """
+        for path, _, action, old, new in self._walk(self.old_dict, self.new_dict, 'value',
+                                                    self.ignore_starting, self.ignore_ending, self._only_keys):
+            yield path, action, old, new
+
+    @staticmethod
+    def _view(value, converted):
+        """(keys, getter) of a dictionary like value or None; converted views lists as index dicts"""
+        if converted and isinstance(value, list):
+            return [f'{index}' for index in range(len(value))], lambda key: value[int(key)]
+        if hasattr(value, 'keys'):
+            return list(value.keys()), value.__getitem__
+        return None
+
+    def _keyed(self, lst):
+        """{str(list_key value): element} if every element has a unique list_key, else None"""
+        if self.list_key is None:
+            return None
+        keyed = {}
+        for element in lst:
+            if not isinstance(element, dict) or self.list_key not in element:
+                return None
+            key = f'{element[self.list_key]}'
+            if key in keyed:
+                return None
+            keyed[key] = element
+        return keyed
+
+    def _matched_lists(self, old_value, new_value):
+        """True if two values are lists compared by list_key or sequence"""
+        if not (isinstance(old_value, list) and isinstance(new_value, list)):
+            return False
+        return self.list_diff == 'sequence' or (self._keyed(old_value) is not None
+                                                and self._keyed(new_value) is not None)
+
+    def _child_mode(self, old_value, new_value):
+        if self._matched_lists(old_value, new_value):
+            return 'list'
+        if isinstance(old_value, list) and isinstance(new_value, list):
+            return 'converted'
+        return 'value'
+
+    def _walk(self, old_value, new_value, mode, ignore_starting=None, ignore_ending=None, only_keys=None):
+        """Explicit stack diff engine
+
+        Yields (path, convertible, action, old, new) where convertible holds a flag per
+        path element: the result at that path becomes a list when all its keys are
+        list indices, as nested deepcompare results always did.
+
+        Modes: 'value' compares dictionaries by key, 'converted' does the same but
+        views lists as index dictionaries and 'list' matches lists by list_key or
+        sequence. Ignored keys and only_keys only apply to the root.
+        """
+        if only_keys is not None and not only_keys:
             return
-        result = {}
-        try:
-            old = self.exclude_keys(old_dict.keys(), ignore_starting, ignore_ending)
-            new = self.exclude_keys(new_dict.keys(), ignore_starting, ignore_ending)
-            overlapping_keys = old & new
-            old_keys = old - new
-            new_keys = new - old
-            if old_keys:
-                for key in old_keys:
-                    result.update({key: {'action': 'del', 'old': old_dict[key]}})
-            if new_keys:
-                for key in new_keys:
-                    result.update({key: {'action': 'add', 'new': new_dict[key]}})
-            for key in overlapping_keys:
-                if isinstance(old_dict[key], list) and isinstance(new_dict[key], list):
-                    old_d = self.listtodict(old_dict[key])
-                    new_d = self.listtodict(new_dict[key])
-                    value = self.deepcompare(old_d, new_d)
-                    if value is None:
-                        continue
-                else:
-                    value = self.deepcompare(old_dict[key], new_dict[key])
-                if value is None:
+        stack = [((), (), old_value, new_value, mode, True)]
+        while stack:
+            path, convertible, old, new, mode, root = stack.pop()
+            try:
+                if old == new:
                     continue
-                if all(f'{index}' == key for index, key in enumerate(sorted(value.keys()))):
-                    value = [v for _, v in value.items()]
-                result.update({key: value})
-        except AttributeError:
-            if old_dict != new_dict:
-                result = {'action': 'mod', 'old': old_dict, 'new': new_dict}
-        finally:
-            if result:
-                return result
+            except RecursionError:
+                # too deep for ==, walk down until it fits
+                pass
+            children = list()
+            if mode == 'list':
+                for key, action, old_child, new_child in self._match_lists(old, new):
+                    if action is None:
+                        children.append((path + (key,), convertible + (False,), old_child, new_child,
+                                         self._child_mode(old_child, new_child), False))
+                    else:
+                        yield path + (key,), convertible + (False,), action, old_child, new_child
+                stack.extend(reversed(children))
+                continue
+            converted = mode == 'converted'
+            out = self.listtodict if converted else _identity
+            old_view, new_view = self._view(old, converted), self._view(new, converted)
+            if old_view is None or new_view is None:
+                yield path, convertible, 'mod', out(old), out(new)
+                continue
+            (old_keys, old_get), (new_keys, new_get) = old_view, new_view
+            if root and (ignore_starting or ignore_ending):
+                try:
+                    old_keys = [k for k in old_keys if k in self.exclude_keys(old_keys, ignore_starting, ignore_ending)]
+                    new_keys = [k for k in new_keys if k in self.exclude_keys(new_keys, ignore_starting, ignore_ending)]
+                except AttributeError:
+                    yield path, convertible, 'mod', old, new
+                    continue
+            if root and only_keys is not None:
+                old_keys = [k for k in old_keys if k in only_keys]
+                new_keys = [k for k in new_keys if k in only_keys]
+            old_set, new_set = set(old_keys), set(new_keys)
+            for key in old_keys:
+                if key not in new_set:
+                    yield path + (key,), convertible + (False,), 'del', out(old_get(key)), None
+            for key in new_keys:
+                if key not in old_set:
+                    yield path + (key,), convertible + (False,), 'add', None, out(new_get(key))
+            for key in old_keys:
+                if key in new_set:
+                    old_child, new_child = old_get(key), new_get(key)
+                    child_mode = mode if converted else self._child_mode(old_child, new_child)
+                    children.append((path + (key,), convertible + (child_mode != 'list',),
+                                     old_child, new_child, child_mode, False))
+            stack.extend(reversed(children))
+
+    def _match_lists(self, old_list, new_list):
+        """(key, action, old, new) per element; action None for matched pairs that need a compare"""
+        old_keyed, new_keyed = self._keyed(old_list), self._keyed(new_list)
+        if old_keyed is not None and new_keyed is not None:
+            for key, element in old_keyed.items():
+                if key not in new_keyed:
+                    yield key, 'del', element, None
+                else:
+                    yield key, None, element, new_keyed[key]
+            for key, element in new_keyed.items():
+                if key not in old_keyed:
+                    yield key, 'add', None, element
+            return
+        matcher = SequenceMatcher(None, [_freeze(v) for v in old_list], [_freeze(v) for v in new_list],
+                                  autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                continue
+            paired = min(i2 - i1, j2 - j1) if tag == 'replace' else 0
+            for offset in range(paired):
+                yield f'{j1 + offset}', None, old_list[i1 + offset], new_list[j1 + offset]
+            for i in range(i1 + paired, i2):
+                yield f'~{i}', 'del', old_list[i], None
+            for j in range(j1 + paired, j2):
+                yield f'{j}', 'add', None, new_list[j]
+
+    @staticmethod
+    def _build_result(records):
+        """Nest flat change records into the deepcompare result structure"""
+        result = {}
+        convertible_nodes = []
+        for path, convertible, action, old, new in records:
+            leaf = {'action': action}
+            if action != 'add':
+                leaf['old'] = old
+            if action != 'del':
+                leaf['new'] = new
+            if not path:
+                return leaf
+            node = result
+            for depth, key in enumerate(path[:-1]):
+                if key not in node:
+                    node[key] = {}
+                    if convertible[depth]:
+                        convertible_nodes.append((node, key))
+                node = node[key]
+            node[path[-1]] = leaf
+        # deepest first, so lists replace dictionaries bottom up
+        for parent, key in reversed(convertible_nodes):
+            value = parent[key]
+            try:
+                if all(f'{index}' == k for index, k in enumerate(sorted(value.keys()))):
+                    parent[key] = list(value.values())
+            except TypeError:
+                continue
+        return result or None
 
     def flat(self, dictionary=None, separator='.', unpack_lists=False):
         if unpack_lists == True:
             return self.unnest(self.listtodict(dictionary or self.result), separator=separator)
         else:
-            return self.unnest(dictionary or self.result, separator=separator)
\ No newline at end of file
+            return self.unnest(dictionary or self.result, separator=separator)
+
+_JSON_SCALARS = {str, int, float, bool, type(None)}
+
+
+def _tagged(value):
+    """JSON encodable form of value in which unequal values stay distinct
+
+    Every array starts with a type tag, so lists, tuples, sets, dicts with non
+    string keys and other objects ('o', type, repr) can't be mistaken for each
+    other. Dicts with string keys remain JSON objects.
+    """
+    kind = type(value)
+    if kind in _JSON_SCALARS:
+        return value
+    if kind is dict and all(type(k) is str for k in value):
+        return {k: v if type(v) in _JSON_SCALARS else _tagged(v) for k, v in value.items()}
+    if kind is list:
+        return ['l'] + [v if type(v) in _JSON_SCALARS else _tagged(v) for v in value]
+    if isinstance(value, (str, int, float)):
+        # subclasses such as bson.Int64 encode as their base type
+        return value
+    if isinstance(value, dict):
+        if all(isinstance(k, str) for k in value):
+            return {k: _tagged(v) for k, v in value.items()}
+        items = [[_tagged(k), _tagged(v)] for k, v in value.items()]
+        return ['d'] + sorted(items, key=lambda item: json.dumps(item[0], sort_keys=True))
+    if isinstance(value, list):
+        return ['l'] + [_tagged(v) for v in value]
+    if isinstance(value, tuple):
+        return ['t'] + [_tagged(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return ['s'] + sorted((_tagged(v) for v in value), key=lambda v: json.dumps(v, sort_keys=True))
+    return ['o', f'{type(value).__module__}.{type(value).__qualname__}', repr(value)]
+
+
+def _strip_private(dictionary):
+    """copy of the dictionary tree without keys starting with '_', like dict_compare; lists are kept"""
+    return {k: _strip_private(v) if isinstance(v, dict) else v
+            for k, v in dictionary.items() if not (isinstance(k, str) and k.startswith('_'))}
+
+
+def fingerprint(value):
+    """Canonical digest of value; equal documents give equal digests, unequal ones differ
+
+    Documents are encoded as sorted key JSON of their type tagged form (see
+    _tagged), so (1, 2) and [1, 2] or {1: 'x'} and {'1': 'x'} differ. Equal
+    values of different types (1, 1.0, True) give different digests too, which
+    only costs a full compare.
+    """
+    encoded = json.dumps(_tagged(value), sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(encoded.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+def fingerprints(document, ignore_starting=None, ignore_ending=None, ignore_private=False):
+    """Digest per top level key of document
+
+    :param ignore_starting: top level keys to be ignored starting with string, as in Compare
+    :param ignore_ending: top level keys to be ignored ending with string, as in Compare
+    :param ignore_private: ignore keys starting with '_' in the document and its nested
+     dictionaries, as dict_compare does
+    """
+    keys = document.keys()
+    if ignore_starting or ignore_ending:
+        keys = Compare.exclude_keys(keys, ignore_starting, ignore_ending)
+    result = {}
+    for key in keys:
+        value = document[key]
+        if ignore_private:
+            if isinstance(key, str) and key.startswith('_'):
+                continue
+            if isinstance(value, dict):
+                value = _strip_private(value)
+        result[key] = fingerprint(value)
+    return result
+
+
+class FingerprintCache(object):
+    """Fingerprints of the last seen version of documents, keyed by document id
+
+    changed_keys() tells which top level keys of a document changed since the
+    previous call for the same id without the previous document at hand, so
+    unchanged documents and subtrees are skipped in O(1) per key. Configure the
+    ignore rules like the comparison it guards (see fingerprints()).
+
+    :param maxsize: keep at most maxsize documents, least recently used are dropped
+    """
+
+    def __init__(self, ignore_starting=None, ignore_ending=None, ignore_private=False, maxsize=None):
+        self.ignore_starting = ignore_starting
+        self.ignore_ending = ignore_ending
+        self.ignore_private = ignore_private
+        self.maxsize = maxsize
+        self._documents = OrderedDict()
+        self.unchanged = 0
+        self.changed = 0
+        self.unknown = 0
+
+    def changed_keys(self, doc_id, document, update=True):
+        """set of top level keys added, deleted or modified since the stored version
+
+        Returns None for unknown documents. With update the document's fingerprints
+        replace the stored ones.
+        """
+        new = fingerprints(document, self.ignore_starting, self.ignore_ending, self.ignore_private)
+        old = self._documents.get(doc_id)
+        if update:
+            self.store_fingerprints(doc_id, new)
+        if old is None:
+            self.unknown += 1
+            return None
+        changed = {k for k in old.keys() | new.keys() if old.get(k) != new.get(k)}
+        if changed:
+            self.changed += 1
+        else:
+            self.unchanged += 1
+        return changed
+
+    def store(self, doc_id, document):
+        self.store_fingerprints(doc_id, fingerprints(document, self.ignore_starting, self.ignore_ending,
+                                                     self.ignore_private))
+
+    def store_fingerprints(self, doc_id, document_fingerprints):
+        self._documents[doc_id] = document_fingerprints
+        self._documents.move_to_end(doc_id)
+        if self.maxsize is not None and len(self._documents) > self.maxsize:
+            self._documents.popitem(last=False)
+
+    def forget(self, doc_id):
+        self._documents.pop(doc_id, None)
+
+    def __len__(self):
+        return len(self._documents)
+
+    @property
+    def stats(self):
+        return dict(documents=len(self._documents),
+                    unchanged=self.unchanged,
+                    changed=self.changed,
+                    unknown=self.unknown)
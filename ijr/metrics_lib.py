@@ -0,0 +1,168 @@
+"""Pluggable metrics for the I/O paths of ijr
+
+MongoReader, MongoWriter, PubSubPublisher, Secrets and Config report latencies,
+batch sizes, bytes and cache hits to the process wide recorder. The default
+recorder does nothing; install another one at start up:
+
+    from ijr.metrics_lib import set_metrics, LoggingMetrics
+    set_metrics(LoggingMetrics())
+
+A recorder implements timing(), histogram() and count() like NullMetrics.
+"""
+import logging
+import time
+from contextlib import contextmanager
+
+
+class NullMetrics(object):
+    """Recorder interface, discards everything"""
+    enabled = False
+
+    def timing(self, name, seconds, **tags):
+        """latency of one call in seconds"""
+
+    def histogram(self, name, value, **tags):
+        """distribution of a size, e.g. documents per batch or bytes per message"""
+
+    def count(self, name, value=1, **tags):
+        """monotonic counter, e.g. cache hits"""
+
+    @contextmanager
+    def span(self, name, **tags):
+        """time the block as `name`, tagged with error=<exception class> when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            tags['error'] = type(e).__name__
+            raise
+        finally:
+            self.timing(name, time.perf_counter() - start, **tags)
+
+
+class LoggingMetrics(NullMetrics):
+    """log every measurement, for local runs and Cloud Logging based metrics"""
+    enabled = True
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('ijr.metrics')
+        self.level = level
+
+    def _log(self, kind, name, value, tags):
+        if self.logger.isEnabledFor(self.level):
+            tags = ' '.join('%s=%s' % item for item in sorted(tags.items()))
+            self.logger.log(self.level, '%s %s %s %s', kind, name, value, tags)
+
+    def timing(self, name, seconds, **tags):
+        self._log('timing', name, '%.6f' % seconds, tags)
+
+    def histogram(self, name, value, **tags):
+        self._log('histogram', name, value, tags)
+
+    def count(self, name, value=1, **tags):
+        self._log('count', name, value, tags)
+
+
+class OpenTelemetryMetrics(NullMetrics):
+    """record through the OpenTelemetry API (opentelemetry-api)
+
+    Timings and sizes become histograms, counts counters; span() also starts a
+    trace span when a tracer is given or `tracing` is True.
+
+    :Parameters:
+     - `meter` (optional): opentelemetry Meter, default the global meter 'ijr'
+     - `tracer` (optional): opentelemetry Tracer for span()
+     - `tracing` (optional): use the global tracer 'ijr' when no tracer is given
+    """
+    enabled = True
+
+    def __init__(self, meter=None, tracer=None, tracing=False):
+        if meter is None:
+            from opentelemetry import metrics
+            meter = metrics.get_meter('ijr')
+        if tracer is None and tracing:
+            from opentelemetry import trace
+            tracer = trace.get_tracer('ijr')
+        self._meter = meter
+        self._tracer = tracer
+        self._instruments = dict()
+
+    def _instrument(self, kind, name, unit=''):
+        instrument = self._instruments.get(name)
+        if instrument is None:
+            if kind == 'counter':
+                instrument = self._meter.create_counter(name, unit=unit)
+            else:
+                instrument = self._meter.create_histogram(name, unit=unit)
+            self._instruments[name] = instrument
+        return instrument
+
+    def timing(self, name, seconds, **tags):
+        self._instrument('histogram', name, 's').record(seconds, attributes=tags)
+
+    def histogram(self, name, value, **tags):
+        self._instrument('histogram', name).record(value, attributes=tags)
+
+    def count(self, name, value=1, **tags):
+        self._instrument('counter', name).add(value, attributes=tags)
+
+    @contextmanager
+    def span(self, name, **tags):
+        if self._tracer is None:
+            with super().span(name, **tags):
+                yield
+            return
+        with self._tracer.start_as_current_span(name, attributes=tags):
+            with super().span(name, **tags):
+                yield
+
+
+_metrics = NullMetrics()
+
+
+def get_metrics():
+    """the process wide recorder"""
+    return _metrics
+
+
+def set_metrics(recorder):
+    """install recorder (None for the no-op default), returns the previous one"""
+    global _metrics
+    previous, _metrics = _metrics, recorder or NullMetrics()
+    return previous
+
+
+def timed(name, **tags):
+    """context manager timing the block with the process wide recorder"""
+    return _metrics.span(name, **tags)
+
+
+def instrumented(iterable, name, **tags):
+    """iterate iterable, reporting the seconds spent producing items as `name`.seconds
+    and the number of items as `name`.items once it is exhausted or closed
+
+    returns iterable itself while metrics are disabled
+    """
+    metrics = _metrics
+    if not metrics.enabled:
+        return iterable
+    return _instrumented(metrics, iter(iterable), name, tags)
+
+
+def _instrumented(metrics, iterator, name, tags):
+    seconds = 0.0
+    items = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                seconds += time.perf_counter() - start
+                return
+            seconds += time.perf_counter() - start
+            items += 1
+            yield item
+    finally:
+        metrics.timing(name + '.seconds', seconds, **tags)
+        metrics.histogram(name + '.items', items, **tags)
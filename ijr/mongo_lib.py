@@ -1,40 +1,486 @@
+import bisect
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from pymongo import MongoClient, ReplaceOne, InsertOne, UpdateOne, UpdateMany
+import bson
+from bson import Binary, Decimal128, ObjectId, Timestamp
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient, ReplaceOne, InsertOne, UpdateOne, UpdateMany, ASCENDING
+from pymongo.errors import BulkWriteError, DocumentTooLarge
+
+from ijr.generic_lib import dict_compare
+from ijr.metrics_lib import get_metrics, instrumented
+
+
+class MongoClientRegistry(object):
+    """Process wide registry of pooled MongoClients
+
+    Clients are keyed by server, user and client options and stay open after the
+    borrowing MongoReader/MongoWriter is closed, so warm Cloud Function
+    invocations reuse the connection pool instead of doing a new TCP+TLS+auth
+    handshake.
+
+    :Parameters:
+     - `max_pool_size` (optional): default maxPoolSize for new clients
+     - `max_idle_time_ms` (optional): default maxIdleTimeMS for new clients
+    """
+
+    def __init__(self, max_pool_size=None, max_idle_time_ms=None):
+        self.max_pool_size = max_pool_size
+        self.max_idle_time_ms = max_idle_time_ms
+        self._clients = dict()
+        self._borrowers = dict()
+        self._lock = threading.Lock()
+        self.handshakes = 0
+        self.handshakes_avoided = 0
+
+    @staticmethod
+    def _key(mdb_server, mdb_user, mdb_pass, options):
+        return mdb_server, mdb_user, hash(mdb_pass), tuple(sorted((k, repr(v)) for k, v in options.items()))
+
+    def _options(self, max_pool_size=None, max_idle_time_ms=None, **client_kwargs):
+        if max_pool_size is None:
+            max_pool_size = self.max_pool_size
+        if max_idle_time_ms is None:
+            max_idle_time_ms = self.max_idle_time_ms
+        return _client_options(max_pool_size, max_idle_time_ms, **client_kwargs)
+
+    def acquire(self, mdb_server, mdb_user, mdb_pass, **client_kwargs):
+        """borrow a client, creating it on first use
+
+        :Parameters:
+         - `max_pool_size` (optional): maxPoolSize for this client
+         - `max_idle_time_ms` (optional): maxIdleTimeMS for this client
+         - `client_kwargs` (optional): extra keyword arguments for MongoClient
+        """
+        options = self._options(**client_kwargs)
+        key = self._key(mdb_server, mdb_user, mdb_pass, options)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = MongoClient('mongodb://%s:%s@%s' % (mdb_user, mdb_pass, mdb_server), **options)
+                self._clients[key] = client
+                self.handshakes += 1
+            else:
+                self.handshakes_avoided += 1
+            self._borrowers[key] = self._borrowers.get(key, 0) + 1
+        return client
+
+    def release(self, client):
+        """return a borrowed client; the client stays open for the next borrower"""
+        with self._lock:
+            for key, value in self._clients.items():
+                if value is client:
+                    self._borrowers[key] = max(self._borrowers.get(key, 0) - 1, 0)
+                    return
+
+    def close_all(self):
+        """close and forget all pooled clients"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._borrowers.clear()
+        for client in clients:
+            client.close()
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(clients=len(self._clients),
+                        borrowed=sum(self._borrowers.values()),
+                        handshakes=self.handshakes,
+                        handshakes_avoided=self.handshakes_avoided)
+
+
+client_registry = MongoClientRegistry()
+
+
+def _client_options(max_pool_size=None, max_idle_time_ms=None, **client_kwargs):
+    """translate the pool knobs to MongoClient keyword arguments"""
+    if max_pool_size is not None:
+        client_kwargs['maxPoolSize'] = max_pool_size
+    if max_idle_time_ms is not None:
+        client_kwargs['maxIdleTimeMS'] = max_idle_time_ms
+    return client_kwargs
+
+
+def _connect(mdb_server, mdb_user, mdb_pass, pooled, client_kwargs):
+    """return a pooled client from the registry or a private one"""
+    if pooled:
+        return client_registry.acquire(mdb_server, mdb_user, mdb_pass, **client_kwargs)
+    # Connect with 3.4 connection-string to Atlas -> user:pwd@server....
+    return MongoClient('mongodb://%s:%s@%s' % (mdb_user, mdb_pass, mdb_server), **_client_options(**client_kwargs))
+
+
+def _disconnect(client, pooled):
+    if pooled:
+        client_registry.release(client)
+    else:
+        client.close()
+
+
+class PipelinedWriteError(Exception):
+    """One or more pipelined bulk writes failed
+
+    `errors` is a list of (exception, statements) tuples, one per failed batch;
+    `ordered` tells whether the batches were written with ordered=True
+    """
+
+    def __init__(self, errors, ordered=True):
+        super().__init__('%d bulk write(s) failed' % len(errors))
+        self.errors = errors
+        self.ordered = ordered
+
+    @property
+    def operations(self):
+        """the statements not written: rejected by the server or, for ordered batches, not run after the
+        first rejected one; the whole batch for other errors"""
+        operations = list()
+        for error, statements in self.errors:
+            if isinstance(error, BulkWriteError):
+                indexes = [e['index'] for e in error.details.get('writeErrors', [])]
+                if self.ordered and indexes:
+                    # the server stops an ordered batch at the first failing statement
+                    operations.extend(statements[min(indexes):])
+                else:
+                    operations.extend(statements[index] for index in indexes)
+            else:
+                operations.extend(statements)
+        return operations
+
+
+class WriteStats(object):
+    """Counters for MongoWriter bulk writes
+
+    Rates are per second spent in bulk_write. bytes are only counted when the
+    writer tracks BSON sizes (max_bytes set). inserted, updated, replaced and
+    skipped count the outcome of change detection (detect_changes set).
+    """
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.batches = 0
+        self.docs = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.latency_histogram = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self.inserted = 0
+        self.updated = 0
+        self.replaced = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def record(self, docs, nbytes, seconds):
+        with self._lock:
+            self.batches += 1
+            self.docs += docs
+            self.bytes += nbytes
+            self.seconds += seconds
+            self.latency_histogram[bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+
+    @property
+    def docs_per_sec(self):
+        return self.docs / self.seconds if self.seconds else 0.0
+
+    @property
+    def bytes_per_sec(self):
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        """counters and the latency histogram as {upper bound in seconds: batches}"""
+        with self._lock:
+            histogram = dict(zip(self.LATENCY_BUCKETS + (float('inf'),), self.latency_histogram))
+            return dict(batches=self.batches, docs=self.docs, bytes=self.bytes, seconds=self.seconds,
+                        docs_per_sec=self.docs_per_sec, bytes_per_sec=self.bytes_per_sec,
+                        latency_histogram=histogram, inserted=self.inserted, updated=self.updated,
+                        replaced=self.replaced, skipped=self.skipped)
 
 
 class MongoWriter(object):
     """A MongoClient for bulk writing operations"""
+    # the server rejects documents over 16 MB
+    MAX_DOCUMENT_BYTES = 16 * 1024 * 1024
 
-    def __init__(self, mdb_server, mdb_user, mdb_pass, db_name, col_name, threshold=250):
+    def __init__(self, mdb_server, mdb_user, mdb_pass, db_name, col_name, threshold=250, pooled=False,
+                 workers=0, queue_size=None, ordered=True, max_bytes=None, adaptive=False,
+                 target_latency=1.0, min_threshold=10, max_threshold=None, detect_changes=False, **client_kwargs):
+        """
+        :Parameters:
+         - `pooled` (optional): borrow the client from `client_registry` instead
+         of owning it; close() then keeps the connection open for reuse
+         - `workers` (optional): number of threads writing filled batches while the
+         caller keeps appending (default 0, write on the caller's thread). With
+         more than one worker batches can reach the server out of order. close()
+         waits for the pipeline and raises PipelinedWriteError for failed batches
+         - `queue_size` (optional): filled batches waiting for a worker before
+         appending blocks (default 2 * workers)
+         - `ordered` (optional): False lets the server apply a batch in parallel and
+         continue after a failing statement
+         - `max_bytes` (optional): write a batch before its BSON size would exceed
+         max_bytes; documents over 16 MB raise DocumentTooLarge when appended
+         - `adaptive` (optional): tune the batch size between `min_threshold` and
+         `max_threshold` (default 10 * threshold) so a bulk_write takes about
+         `target_latency` seconds
+         - `detect_changes` (optional): for documents written with a doc_key, fetch
+         the stored versions per batch and compare them with dict_compare: unchanged
+         documents are skipped and changed ones get an UpdateOne with $set/$unset of
+         the changed fields and _ts. Fields starting with '_' don't count as changes.
+         Documents following an edit_data or write_document statement, in the batch
+         or in flight, are replaced as usual
+         - `client_kwargs` (optional): MongoClient options, including the pool
+         knobs `max_pool_size` and `max_idle_time_ms`
+        """
         self.db_name = db_name
         self.col_name = col_name
         self._statements = list()
-        # Connect with 3.4 connection-string to Atlas -> user:pwd@server....
-        self._client = MongoClient('mongodb://%s:%s@%s' % (mdb_user, mdb_pass, mdb_server))
+        self._statements_bytes = 0
+        self._pooled = pooled
+        self._client = _connect(mdb_server, mdb_user, mdb_pass, pooled, client_kwargs)
         self._threshold = threshold
         self._write_counter = 0
+        self._ordered = ordered
+        self._max_bytes = max_bytes
+        self._adaptive = adaptive
+        self._target_latency = target_latency
+        self._min_threshold = min_threshold
+        self._max_threshold = max_threshold or 10 * threshold
+        self.stats = WriteStats()
+        self._detect_changes = detect_changes
+        self._change_docs = dict()
+        self._inflight_docs = dict()
+        self._inflight_edits = 0
+        self._batch_seq = 0
+        self._inflight_lock = threading.Lock()
+        self._errors = list()
+        self._errors_lock = threading.Lock()
+        self._workers = list()
+        if workers:
+            self._queue = queue.Queue(maxsize=queue_size or 2 * workers)
+            for _ in range(workers):
+                worker = threading.Thread(target=self._run_worker, daemon=True)
+                worker.start()
+                self._workers.append(worker)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close()
+        if exc_type is None:
+            self.close()
+        else:
+            try:
+                self.close()
+            except Exception:
+                # don't mask the original exception with write failures
+                pass
+
+    @property
+    def threshold(self):
+        """current batch size, tuned from bulk_write latency when adaptive"""
+        return self._threshold
+
+    def _bulk_write(self, statements, nbytes=0):
+        db = self._client.get_database(self.db_name)
+        coll = db.get_collection(self.col_name)
+        metrics = get_metrics()
+        start = time.perf_counter()
+        try:
+            coll.bulk_write(statements, ordered=self._ordered)
+        except Exception as e:
+            metrics.count('mongo.bulk_write.errors', db=self.db_name, collection=self.col_name,
+                          error=type(e).__name__)
+            raise
+        latency = time.perf_counter() - start
+        self.stats.record(len(statements), nbytes, latency)
+        if metrics.enabled:
+            metrics.timing('mongo.bulk_write.seconds', latency, db=self.db_name, collection=self.col_name)
+            metrics.histogram('mongo.bulk_write.docs', len(statements), db=self.db_name, collection=self.col_name)
+            if nbytes:
+                metrics.histogram('mongo.bulk_write.bytes', nbytes, db=self.db_name, collection=self.col_name)
+        if self._adaptive:
+            self._adapt(len(statements), latency)
+
+    def _adapt(self, size, latency):
+        """grow fast batches, shrink slow ones; only full batches say something about the limit"""
+        if latency > self._target_latency:
+            self._threshold = max(self._min_threshold, min(self._threshold, size) // 2)
+        elif latency < self._target_latency / 2 and size >= self._threshold:
+            self._threshold = min(self._max_threshold, self._threshold * 2)
+
+    def _run_worker(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            statements, nbytes, seq, edits = batch
+            try:
+                self._bulk_write(statements, nbytes)
+            except Exception as e:
+                with self._errors_lock:
+                    self._errors.append((e, statements))
+            finally:
+                self._batch_done(seq, edits)
+
+    def _batch_done(self, seq, edits):
+        """forget the in flight versions written by batch seq"""
+        with self._inflight_lock:
+            for _id in [k for k, (_, s) in self._inflight_docs.items() if s == seq]:
+                del self._inflight_docs[_id]
+            if edits:
+                self._inflight_edits -= 1
 
     def _write_to_server(self):
         """bulk write statements to the server"""
+        # while a batch with edit_data statements is in flight the stored documents can't be trusted
+        edits = bool(self._workers) and self._detect_changes and any(
+            isinstance(statement, (UpdateOne, UpdateMany, ReplaceOne)) and id(statement) not in self._change_docs
+            for statement in self._statements)
+        written = self._resolve_changes() if self._change_docs else dict()
         if not self._statements:
+            # change detection dropped the whole batch
+            self._statements_bytes = 0
             return
-        db = self._client.get_database(self.db_name)
-        coll = db.get_collection(self.col_name)
-        coll.bulk_write(self._statements)
+        if self._workers:
+            self._batch_seq += 1
+            if self._detect_changes:
+                with self._inflight_lock:
+                    for _id, doc in written.items():
+                        self._inflight_docs[_id] = (doc, self._batch_seq)
+                    if edits:
+                        self._inflight_edits += 1
+            # blocks while the queue is full
+            self._queue.put((list(self._statements), self._statements_bytes, self._batch_seq, edits))
+        else:
+            self._bulk_write(self._statements, self._statements_bytes)
         self._statements.clear()
+        self._statements_bytes = 0
         self._write_counter += 1
 
+    def _resolve_changes(self):
+        """replace the upserts of detect_changes documents by targeted updates or drop them
+
+        returns {_id: document} of the documents written by the batch
+        """
+        change_docs, self._change_docs = self._change_docs, dict()
+        coll = self._client.get_database(self.db_name).get_collection(self.col_name)
+        ids = list({doc['_id'] for doc, _ in change_docs.values()})
+        with self._inflight_lock:
+            # taken before the find: a batch finishing in between is then either in the
+            # snapshot or in the stored versions
+            inflight = {_id: doc for _id, (doc, _) in self._inflight_docs.items() if _id in ids}
+            after_edit = self._inflight_edits > 0
+        current = {doc['_id']: doc for doc in coll.find({'_id': {'$in': ids}})}
+        # versions in batches not yet written win over the stored ones
+        current.update(inflight)
+        written = dict()
+        statements = list()
+        for statement in self._statements:
+            change = change_docs.get(id(statement))
+            if change is None:
+                after_edit = after_edit or isinstance(statement, (UpdateOne, UpdateMany, ReplaceOne))
+                statements.append(statement)
+                continue
+            doc, nbytes = change
+            # compare the document as the server stores it, e.g. datetimes in milliseconds and tuples as lists
+            doc = bson.decode(bson.encode(doc), coll.codec_options)
+            stored = current.get(doc['_id'])
+            current[doc['_id']] = doc
+            written[doc['_id']] = doc
+            if after_edit:
+                self.stats.replaced += 1
+                statements.append(statement)
+            elif stored is None:
+                self.stats.inserted += 1
+                statements.append(statement)
+            else:
+                update = self._change_update(stored, doc)
+                # the batch size counts the update instead of the replaced document
+                self._statements_bytes -= nbytes
+                if update is None:
+                    self.stats.skipped += 1
+                    continue
+                self.stats.updated += 1
+                if self._max_bytes is not None:
+                    self._statements_bytes += len(bson.encode(update))
+                statements.append(UpdateOne(filter={'_id': doc['_id']}, update=update))
+        self._statements[:] = statements
+        return written
+
+    @staticmethod
+    def _change_update(stored, doc):
+        """$set/$unset update for the fields dict_compare reports, None if unchanged"""
+        changes = dict_compare(stored, doc)
+        if not changes:
+            return None
+        set_fields, unset_fields, whole_fields = dict(), dict(), set()
+        for key, change in changes.items():
+            path = key.split('|')
+            source = stored if change['action'] == 'del' else doc
+            value = source
+            for part in path:
+                if not part or '.' in part or part.startswith('$') or not isinstance(value, dict) \
+                        or part not in value:
+                    # ambiguous or not addressable with dot notation, write the top level field
+                    whole_fields.add(path[0])
+                    break
+                value = value[part]
+            else:
+                if change['action'] == 'del':
+                    unset_fields['.'.join(path)] = ''
+                else:
+                    set_fields['.'.join(path)] = value
+        for field in whole_fields:
+            set_fields = {k: v for k, v in set_fields.items() if k.split('.')[0] != field}
+            unset_fields = {k: v for k, v in unset_fields.items() if k.split('.')[0] != field}
+            if field in doc:
+                set_fields[field] = doc[field]
+            else:
+                unset_fields[field] = ''
+        set_fields['_ts'] = doc['_ts']
+        update = {'$set': set_fields}
+        if unset_fields:
+            update['$unset'] = unset_fields
+        return update
+
+    def _append(self, statement, *docs, change_doc=None):
+        """add a statement, writing the batch when it is full by count or size
+
+        `change_doc` registers the document of a detect_changes upsert, after a
+        size triggered write so it is resolved with the batch it ends up in
+        """
+        nbytes = 0
+        if self._max_bytes is not None:
+            sizes = [len(bson.encode(doc)) for doc in docs]
+            if max(sizes) > self.MAX_DOCUMENT_BYTES:
+                raise DocumentTooLarge('document of %d bytes exceeds the 16 MB limit' % max(sizes))
+            nbytes = sum(sizes)
+            if self._statements and self._statements_bytes + nbytes > self._max_bytes:
+                self._write_to_server()
+            self._statements_bytes += nbytes
+        if change_doc is not None:
+            self._change_docs[id(statement)] = (change_doc, nbytes)
+        self._statements.append(statement)
+        if len(self._statements) > self._threshold:
+            self._write_to_server()
+
     def close(self):
         """write statements and disconnect from MongoDB."""
-        self._write_to_server()
-        self._client.close()
+        try:
+            self._write_to_server()
+        finally:
+            for _ in self._workers:
+                self._queue.put(None)
+            for worker in self._workers:
+                worker.join()
+            self._workers.clear()
+            _disconnect(self._client, self._pooled)
+        if self._errors:
+            errors, self._errors = self._errors, list()
+            raise PipelinedWriteError(errors, self._ordered)
 
     def write_data(self, doc: dict, doc_key: str = None, force_timestamp=True):
         """write document with _ts (timestamp) included
@@ -50,13 +496,29 @@ class MongoWriter(object):
             doc['_ts'] = doc.get('_ts', datetime.now())
         if doc_key is not None:
             doc['_id'] = '%s' % doc_key
-            self._statements.append(ReplaceOne(filter={'_id': doc['_id']}, 
-                                               replacement=doc, 
-                                               upsert=True))
+            statement = ReplaceOne(filter={'_id': doc['_id']},
+                                   replacement=doc,
+                                   upsert=True)
+            self._append(statement, doc, change_doc=doc if self._detect_changes else None)
         else:
-            self._statements.append(InsertOne(document=doc))
-        if len(self._statements) > self._threshold:
-            self._write_to_server()
+            self._append(InsertOne(document=doc), doc)
+        return self._write_counter
+
+    def write_document(self, doc: dict):
+        """write document as is, without _ts and with its _id value unchanged
+
+        Documents with an _id replace the stored document (upsert), others are
+        inserted. Not subject to detect_changes.
+
+        :Parameters:
+         - `doc`: A document to be written
+        """
+        if '_id' in doc:
+            self._append(ReplaceOne(filter={'_id': doc['_id']},
+                                    replacement=doc,
+                                    upsert=True), doc)
+        else:
+            self._append(InsertOne(document=doc), doc)
         return self._write_counter
 
     def edit_data(self, query: dict, field: dict, mode: str):
@@ -82,20 +544,31 @@ class MongoWriter(object):
             raise ValueError('Invalid mode. Expected one of: {"one", "many"}')
 
         if mode == "one":
-            self._statements.append(UpdateOne(filter=query,
-                                              update={'$set': field}))
+            self._append(UpdateOne(filter=query,
+                                   update={'$set': field}), query, field)
 
         elif mode == "many":
-            self._statements.append(UpdateMany(filter=query,
-                                               update={'$set': field}))
+            self._append(UpdateMany(filter=query,
+                                    update={'$set': field}), query, field)
+
+
+# $type aliases of the values range queries compare within, in isinstance order
+_RANGE_TYPES = ((bool, 'bool'), ((int, float, Decimal128), 'number'), (str, 'string'), (ObjectId, 'objectId'),
+                (datetime, 'date'), (Timestamp, 'timestamp'), ((bytes, Binary), 'binData'))
 
-        if len(self._statements) > self._threshold:
-            self._write_to_server()
+
+def _range_type(value):
+    """$type alias of value for range partitioning, None for types that aren't partitioned"""
+    for types, alias in _RANGE_TYPES:
+        if isinstance(value, types):
+            return alias
+    return None
 
 
 class MongoReader(object):
-    def __init__(self, mdb_server, mdb_user, mdb_pass):
-        self._client = MongoClient('mongodb://%s:%s@%s' % (mdb_user, mdb_pass, mdb_server))
+    def __init__(self, mdb_server, mdb_user, mdb_pass, pooled=False, **client_kwargs):
+        self._pooled = pooled
+        self._client = _connect(mdb_server, mdb_user, mdb_pass, pooled, client_kwargs)
 
     def __enter__(self):
         return self
@@ -104,26 +577,212 @@ class MongoReader(object):
         self.close()
 
     def close(self):
-        self._client.close()
+        _disconnect(self._client, self._pooled)
 
-    def find(self, db_name, collection_name, query, sorting=None, limit=-1, projection=None):
+    def _collection(self, db_name, collection_name, raw_bson=False):
         db = self._client.get_database(db_name)
         col = db.get_collection(collection_name)
-        ret = col.find(query, projection)
+        if raw_bson:
+            col = col.with_options(codec_options=col.codec_options.with_options(document_class=RawBSONDocument))
+        return col
+
+    @staticmethod
+    def _find_kwargs(sorting, limit, batch_size, hint, max_time_ms):
+        kwargs = dict()
         if sorting:
-            ret.sort(sorting)
+            if isinstance(sorting, str):
+                sorting = [(sorting, ASCENDING)]
+            kwargs['sort'] = sorting
         if limit > 0:
-            ret.limit(limit=limit)
-        for r in ret:
+            kwargs['limit'] = limit
+        if batch_size:
+            kwargs['batch_size'] = batch_size
+        if hint is not None:
+            kwargs['hint'] = hint
+        if max_time_ms is not None:
+            kwargs['max_time_ms'] = max_time_ms
+        return kwargs
+
+    @staticmethod
+    def _aggregate_kwargs(batch_size, hint, max_time_ms):
+        kwargs = dict(allowDiskUse=True)
+        if batch_size:
+            kwargs['batchSize'] = batch_size
+        if hint is not None:
+            kwargs['hint'] = hint
+        if max_time_ms is not None:
+            kwargs['maxTimeMS'] = max_time_ms
+        return kwargs
+
+    def find(self, db_name, collection_name, query, sorting=None, limit=-1, projection=None, batch_size=None,
+             raw_bson=False, hint=None, max_time_ms=None):
+        """yield the documents matching query
+
+        :Parameters:
+         - `batch_size` (optional): documents per server round trip
+         - `raw_bson` (optional): yield RawBSONDocuments, decoded lazily on field access
+         - `hint` (optional): index name or specification to use
+         - `max_time_ms` (optional): server side time limit in milliseconds
+        """
+        col = self._collection(db_name, collection_name, raw_bson)
+        ret = col.find(query, projection, **self._find_kwargs(sorting, limit, batch_size, hint, max_time_ms))
+        for r in instrumented(ret, 'mongo.find', db=db_name, collection=collection_name):
             yield r
 
-    def aggregate(self, db_name, collection_name, pipeline):
-        db = self._client.get_database(db_name)
-        col = db.get_collection(collection_name)
-        ret = col.aggregate(pipeline, allowDiskUse=True)
-        for r in ret:
+    def find_raw_batches(self, db_name, collection_name, query, sorting=None, limit=-1, projection=None,
+                         batch_size=1000, hint=None, max_time_ms=None):
+        """yield undecoded server batches, each bytes of concatenated BSON documents
+
+        parameters as for find()
+        """
+        col = self._collection(db_name, collection_name)
+        ret = col.find_raw_batches(query, projection,
+                                   **self._find_kwargs(sorting, limit, batch_size, hint, max_time_ms))
+        for batch in instrumented(ret, 'mongo.find_raw_batches', db=db_name, collection=collection_name):
+            yield batch
+
+    def find_batches(self, db_name, collection_name, query, sorting=None, limit=-1, projection=None,
+                     batch_size=1000, raw_bson=False, hint=None, max_time_ms=None):
+        """yield lists of documents, one list per server batch
+
+        Each batch is decoded in one call instead of per document; parameters as for find()
+        """
+        col = self._collection(db_name, collection_name, raw_bson)
+        ret = col.find_raw_batches(query, projection,
+                                   **self._find_kwargs(sorting, limit, batch_size, hint, max_time_ms))
+        return self._decode_batches(col, ret, 'mongo.find_batches', db_name, collection_name)
+
+    def aggregate(self, db_name, collection_name, pipeline, batch_size=None, raw_bson=False, hint=None,
+                  max_time_ms=None):
+        col = self._collection(db_name, collection_name, raw_bson)
+        ret = col.aggregate(pipeline, **self._aggregate_kwargs(batch_size, hint, max_time_ms))
+        for r in instrumented(ret, 'mongo.aggregate', db=db_name, collection=collection_name):
             yield r
 
+    def aggregate_batches(self, db_name, collection_name, pipeline, batch_size=1000, raw_bson=False, hint=None,
+                          max_time_ms=None):
+        """yield lists of aggregation results, one list per server batch"""
+        col = self._collection(db_name, collection_name, raw_bson)
+        ret = col.aggregate_raw_batches(pipeline, **self._aggregate_kwargs(batch_size, hint, max_time_ms))
+        return self._decode_batches(col, ret, 'mongo.aggregate_batches', db_name, collection_name)
+
+    @staticmethod
+    def _decode_batches(col, raw_batches, name, db_name, collection_name):
+        metrics = get_metrics()
+        for batch in instrumented(raw_batches, name, db=db_name, collection=collection_name):
+            docs = bson.decode_all(batch, col.codec_options)
+            if metrics.enabled:
+                metrics.histogram(name + '.docs', len(docs), db=db_name, collection=collection_name)
+                metrics.histogram(name + '.bytes', len(batch), db=db_name, collection=collection_name)
+            yield docs
+
+    def partition_bounds(self, db_name, collection_name, query, partitions=4, key='_id', samples_per_partition=20):
+        """Split points dividing the documents matching query into about equal ranges of key
+
+        The bounds are quantiles of a $sample of partitions * samples_per_partition
+        documents, sorted by the server. Fewer bounds are returned for small or
+        skewed collections. When the sampled values have more than one BSON type
+        the bounds are taken from the most common one.
+        """
+        sample = [{'$match': query},
+                  {'$sample': {'size': partitions * samples_per_partition}},
+                  {'$project': {'_id': 0, '_key': '$' + key}},
+                  {'$sort': {'_key': ASCENDING}}]
+        values = [d['_key'] for d in self.aggregate(db_name, collection_name, sample) if '_key' in d]
+        if values:
+            range_type = Counter(_range_type(value) for value in values).most_common(1)[0][0]
+            # values of types without a range order are left to the catch-all partition
+            values = [value for value in values if _range_type(value) == range_type] if range_type else []
+        bounds = list()
+        for i in range(1, partitions):
+            if not values:
+                break
+            value = values[i * len(values) // partitions]
+            if not bounds or bounds[-1] != value:
+                bounds.append(value)
+        return bounds
+
+    def partition_queries(self, db_name, collection_name, query, partitions=4, key='_id', samples_per_partition=20):
+        """query split in range queries on key, one per partition
+
+        Range queries only match values of the same BSON type as the bounds, so a
+        last query matches the documents where key is missing or of another type.
+        Array values of key can match more than one partition.
+        """
+        bounds = self.partition_bounds(db_name, collection_name, query, partitions, key, samples_per_partition)
+        if not bounds:
+            return [query]
+        conditions = list()
+        for lower, upper in zip([None] + bounds, bounds + [None]):
+            condition = dict()
+            if lower is not None:
+                condition['$gte'] = lower
+            if upper is not None:
+                condition['$lt'] = upper
+            conditions.append(condition)
+        # everything the ranges don't compare with, including a missing key
+        conditions.append({'$not': {'$type': _range_type(bounds[0])}})
+        return [{'$and': [query, {key: condition}]} if query else {key: condition} for condition in conditions]
+
+    def partitioned_find(self, db_name, collection_name, query, partitions=4, key='_id', **find_kwargs):
+        """one lazy find() iterator per partition, to be consumed concurrently by the caller"""
+        return [self.find(db_name, collection_name, q, **find_kwargs)
+                for q in self.partition_queries(db_name, collection_name, query, partitions, key)]
+
+    def parallel_find(self, db_name, collection_name, query, partitions=4, key='_id', workers=None,
+                      projection=None, batch_size=1000, raw_bson=False, max_time_ms=None):
+        """yield the documents matching query, scanning the partitions concurrently
+
+        Documents arrive in no particular order; documents where key is missing or
+        of another type than most are scanned as one more partition (see
+        partition_queries()).
+
+        :Parameters:
+         - `workers` (optional): threads scanning partitions (default partitions)
+        """
+        queries = self.partition_queries(db_name, collection_name, query, partitions, key)
+        batches = queue.Queue(maxsize=2 * len(queries))
+        stop = threading.Event()
+        done = object()
+
+        def offer(item):
+            """put item on the queue unless the consumer went away"""
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def scan(partition_query):
+            try:
+                for batch in self.find_batches(db_name, collection_name, partition_query, projection=projection,
+                                               batch_size=batch_size, raw_bson=raw_bson, max_time_ms=max_time_ms):
+                    if not offer(batch):
+                        return
+            except Exception as e:
+                offer(e)
+            finally:
+                offer(done)
+
+        with ThreadPoolExecutor(max_workers=workers or len(queries)) as executor:
+            for partition_query in queries:
+                executor.submit(scan, partition_query)
+            try:
+                running = len(queries)
+                while running:
+                    batch = batches.get()
+                    if batch is done:
+                        running -= 1
+                    elif isinstance(batch, Exception):
+                        raise batch
+                    else:
+                        for doc in batch:
+                            yield doc
+            finally:
+                stop.set()
+
     def collections(self, db_name):
         db = self._client.get_database(db_name)
         return db.list_collection_names()
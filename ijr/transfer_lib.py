@@ -0,0 +1,190 @@
+"""Streaming transfer of collections between MongoDB and JSON lines or BSON files
+
+Exports read raw server batches in _id order and write them batch by batch, so
+memory stays bounded by the batch size. Files are JSON lines in MongoDB Extended
+JSON (datetimes, ObjectIds and other BSON types survive the round trip) or BSON
+documents back to back (mongodump's format), optionally gzip compressed.
+The format and compression follow the file name unless given:
+'.jsonl', '.json', '.bson', each optionally with '.gz'.
+
+An interrupted export continues after the last complete document in the file
+with resume=True; an import continues after a given _id with `after_id`, e.g.
+the `last_id` an earlier import returned.
+"""
+import gzip
+import os
+import struct
+import zlib
+
+import bson
+from bson import json_util
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.raw_bson import RawBSONDocument
+
+FORMATS = {'jsonl', 'bson'}
+COMPRESSIONS = {None, 'gzip'}
+_RAW_OPTIONS = DEFAULT_CODEC_OPTIONS.with_options(document_class=RawBSONDocument)
+_TRUNCATED = (EOFError, gzip.BadGzipFile, zlib.error)
+
+
+def _file_options(path, file_format, compression):
+    """format and compression, from the file name when not given"""
+    name = path[:-3] if path.endswith('.gz') else path
+    if compression is None and path.endswith('.gz'):
+        compression = 'gzip'
+    if file_format is None:
+        file_format = 'bson' if name.endswith('.bson') else 'jsonl'
+    if file_format not in FORMATS:
+        raise ValueError('Invalid file_format. Expected one of: {"jsonl", "bson"}')
+    if compression not in COMPRESSIONS:
+        raise ValueError('Invalid compression. Expected one of: {None, "gzip"}')
+    return file_format, compression
+
+
+def _open(path, mode, compression):
+    if compression == 'gzip':
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _records(f, file_format):
+    """yield the complete records of an open export file as bytes
+
+    raises EOFError when the file ends in the middle of a record
+    """
+    if file_format == 'jsonl':
+        for line in f:
+            if not line.endswith(b'\n'):
+                raise EOFError('export ends with a partial line')
+            if line.strip():
+                yield line
+        return
+    while True:
+        head = f.read(4)
+        if not head:
+            return
+        if len(head) < 4:
+            raise EOFError('export ends with a partial document')
+        size = struct.unpack('<i', head)[0]
+        body = f.read(size - 4)
+        if len(body) < size - 4:
+            raise EOFError('export ends with a partial document')
+        yield head + body
+
+
+def _decode(record, file_format, json_options, codec_options=DEFAULT_CODEC_OPTIONS):
+    if file_format == 'jsonl':
+        return json_util.loads(record, json_options=json_options)
+    return bson.decode(record, codec_options)
+
+
+def _resume_point(path, file_format, compression, json_options):
+    """_id of the last complete document in an existing export, None if there is none
+
+    A partially written last document is removed; for gzip files the complete
+    documents are copied to a new file.
+    """
+    last, count, offset, truncated = None, 0, 0, False
+    with _open(path, 'rb', compression) as f:
+        try:
+            for last in _records(f, file_format):
+                count += 1
+                offset += len(last)
+        except _TRUNCATED:
+            truncated = True
+    if truncated:
+        if compression is None:
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        else:
+            with _open(path, 'rb', compression) as src, _open(path + '.tmp', 'wb', compression) as dst:
+                records = _records(src, file_format)
+                for _ in range(count):
+                    dst.write(next(records))
+            os.replace(path + '.tmp', path)
+    if last is None:
+        return None
+    return _decode(last, file_format, json_options, _RAW_OPTIONS)['_id']
+
+
+def export_collection(reader, db_name, collection_name, path, query=None, projection=None, batch_size=1000,
+                      file_format=None, compression=None, resume=False, json_options=None):
+    """write the documents matching query to path, in _id order
+
+    :Parameters:
+     - `reader`: MongoReader
+     - `file_format` (optional): 'jsonl' or 'bson', default from the file name
+     - `compression` (optional): None or 'gzip', default from the file name
+     - `resume` (optional): append the documents after the last complete one
+     already in path instead of overwriting it
+     - `json_options` (optional): bson.json_util.JSONOptions for 'jsonl',
+     default relaxed Extended JSON
+
+    returns dict(docs=<documents written>, last_id=<_id of the last document>)
+    """
+    file_format, compression = _file_options(path, file_format, compression)
+    json_options = json_options or json_util.RELAXED_JSON_OPTIONS
+    query = query or dict()
+    last_id = None
+    if resume and os.path.exists(path):
+        last_id = _resume_point(path, file_format, compression, json_options)
+    if last_id is not None:
+        query = {'$and': [query, {'_id': {'$gt': last_id}}]} if query else {'_id': {'$gt': last_id}}
+    docs = 0
+    with _open(path, 'ab' if resume else 'wb', compression) as f:
+        for batch in reader.find_raw_batches(db_name, collection_name, query, sorting='_id', projection=projection,
+                                             batch_size=batch_size):
+            if file_format == 'bson':
+                # RawBSONDocuments only split the batch, fields are decoded on access
+                batch_docs = bson.decode_all(batch, _RAW_OPTIONS)
+                f.write(batch)
+            else:
+                batch_docs = bson.decode_all(batch)
+                f.write(''.join(json_util.dumps(doc, json_options=json_options) + '\n'
+                                for doc in batch_docs).encode())
+            if batch_docs:
+                docs += len(batch_docs)
+                last_id = batch_docs[-1]['_id']
+    return dict(docs=docs, last_id=last_id)
+
+
+def read_export(path, file_format=None, compression=None, json_options=None, codec_options=None):
+    """yield the documents of an export file one at a time
+
+    raises EOFError when the file ends in the middle of a document
+    """
+    file_format, compression = _file_options(path, file_format, compression)
+    json_options = json_options or json_util.RELAXED_JSON_OPTIONS
+    codec_options = codec_options or DEFAULT_CODEC_OPTIONS
+    with _open(path, 'rb', compression) as f:
+        for record in _records(f, file_format):
+            yield _decode(record, file_format, json_options, codec_options)
+
+
+def import_collection(writer, path, file_format=None, compression=None, after_id=None, json_options=None):
+    """write the documents of an export file with writer.write_document()
+
+    Documents with an _id replace the stored ones, so importing a file again is
+    safe. The writer batches the bulk writes; close it (or leave its with block)
+    to write the last batch.
+
+    :Parameters:
+     - `writer`: MongoWriter
+     - `after_id` (optional): skip the documents up to and including the one
+     with this _id, to continue an interrupted import of an _id ordered export.
+     Raises ValueError when the file has no document with this _id
+
+    returns dict(docs=<documents written>, last_id=<_id of the last document>)
+    """
+    docs, last_id = 0, None
+    skipping = after_id is not None
+    for doc in read_export(path, file_format, compression, json_options):
+        if skipping:
+            skipping = doc.get('_id') != after_id
+            continue
+        writer.write_document(doc)
+        docs += 1
+        last_id = doc.get('_id')
+    if skipping:
+        raise ValueError('after_id %r not found in %s' % (after_id, path))
+    return dict(docs=docs, last_id=last_id)
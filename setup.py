@@ -13,5 +13,9 @@ setup(
     author='IT team IJsvogel Retail',
     author_email='it@ijsvogelretail.nl',
     description='IJsvogel Package',
-    install_requires=['pymongo', 'google-cloud-pubsub', 'google-cloud-secret-manager']
+    install_requires=['pymongo>=3.9.0', 'google-cloud-pubsub', 'google-cloud-secret-manager'],
+    extras_require={'async': ['pymongo>=4.9'],
+                    'fast': ['orjson', 'msgpack', 'zstandard'],
+                    'otel': ['opentelemetry-api'],
+                    'bench': ['pytest', 'pytest-benchmark']}
 )
@@ -0,0 +1,198 @@
+import asyncio
+import unittest
+
+from pymongo.errors import BulkWriteError
+
+from ijr.async_mongo_lib import AsyncMongoReader, AsyncMongoWriter
+from ijr.mongo_lib import PipelinedWriteError
+
+
+class FakeAsyncCollection(object):
+    """stands in for an async collection, tracks concurrent bulk writes"""
+
+    def __init__(self, fail_on=None):
+        self.batches = list()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.fail_on = fail_on
+
+    async def bulk_write(self, statements, ordered=True):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        for index, statement in enumerate(statements):
+            if statement._doc.get('i') == self.fail_on:
+                raise BulkWriteError({'writeErrors': [{'index': index, 'code': 11000, 'errmsg': 'duplicate'}]})
+        self.batches.append(statements)
+
+    def get_collection(self, name, **kwargs):
+        return self
+
+    def get_database(self, name, **kwargs):
+        return self
+
+    async def close(self):
+        pass
+
+
+class FakeAsyncCursor(object):
+    """async iterable over documents, applying sort() and limit() like a cursor"""
+
+    def __init__(self, documents):
+        self.documents = list(documents)
+        self.sorting = None
+        self.limited = None
+
+    def sort(self, sorting):
+        self.sorting = sorting
+        for key, direction in reversed(sorting):
+            self.documents.sort(key=lambda doc: doc[key], reverse=direction < 0)
+        return self
+
+    def limit(self, limit):
+        self.limited = limit
+        self.documents = self.documents[:limit]
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.documents:
+            yield doc
+
+
+class FakeAsyncReadCollection(object):
+    """stands in for the client, database and collection of a reader
+
+    `awaitable_aggregate` mimics pymongo's AsyncCollection.aggregate, which is a
+    coroutine; motor returns the cursor at once.
+    """
+
+    def __init__(self, documents, awaitable_aggregate=True):
+        self.documents = documents
+        self.awaitable_aggregate = awaitable_aggregate
+        self.cursors = list()
+        self.pipelines = list()
+
+    def get_database(self, name, **kwargs):
+        return self
+
+    def get_collection(self, name, **kwargs):
+        return self
+
+    def find(self, query, projection=None):
+        cursor = FakeAsyncCursor(doc for doc in self.documents if all(doc.get(k) == v for k, v in query.items()))
+        self.cursors.append(cursor)
+        return cursor
+
+    def aggregate(self, pipeline, **kwargs):
+        self.pipelines.append((pipeline, kwargs))
+        cursor = FakeAsyncCursor(self.documents)
+        if not self.awaitable_aggregate:
+            return cursor
+
+        async def command():
+            return cursor
+        return command()
+
+    async def list_collection_names(self):
+        return ['a', 'b']
+
+    def close(self):
+        pass
+
+
+def reader(collection):
+    mr = AsyncMongoReader('localhost', 'user', 'pass', connect=False)
+    mr._client = collection
+    return mr
+
+
+async def collect(iterator):
+    return [doc async for doc in iterator]
+
+
+def writer(collection, **kwargs):
+    mw = AsyncMongoWriter('localhost', 'user', 'pass', 'db', 'col', connect=False, **kwargs)
+    mw._client = collection
+    return mw
+
+
+class TestAsyncMongoWriter(unittest.TestCase):
+
+    def test_concurrent_batches(self):
+        col = FakeAsyncCollection()
+
+        async def run():
+            async with writer(col, threshold=9, max_in_flight=3) as mw:
+                for i in range(100):
+                    await mw.write_data({'i': i})
+
+        asyncio.run(run())
+        self.assertEqual(sum(len(b) for b in col.batches), 100)
+        self.assertEqual(col.max_in_flight, 3)
+
+    def test_errors(self):
+        col = FakeAsyncCollection(fail_on=5)
+
+        async def run():
+            mw = writer(col, threshold=9)
+            for i in range(30):
+                await mw.write_data({'i': i})
+            await mw.close()
+
+        with self.assertRaises(PipelinedWriteError) as cm:
+            asyncio.run(run())
+        self.assertEqual([op._doc['i'] for op in cm.exception.operations], [5, 6, 7, 8, 9])
+
+    def test_exit_keeps_caller_exception(self):
+        col = FakeAsyncCollection(fail_on=5)
+
+        async def run():
+            async with writer(col, threshold=9) as mw:
+                for i in range(30):
+                    await mw.write_data({'i': i})
+                raise KeyError('caller')
+
+        with self.assertRaises(KeyError):
+            asyncio.run(run())
+
+
+class TestAsyncMongoReader(unittest.TestCase):
+
+    def setUp(self):
+        self.documents = [{'_id': i, 'kind': i % 2, 'rank': -i} for i in range(10)]
+
+    def test_find(self):
+        col = FakeAsyncReadCollection(self.documents)
+
+        async def run():
+            async with reader(col) as mr:
+                return await collect(mr.find('db', 'col', {'kind': 1}, sorting=[('rank', 1)], limit=3))
+
+        self.assertEqual([doc['_id'] for doc in asyncio.run(run())], [9, 7, 5])
+        self.assertEqual((col.cursors[0].sorting, col.cursors[0].limited), ([('rank', 1)], 3))
+
+    def test_find_without_sort_or_limit(self):
+        col = FakeAsyncReadCollection(self.documents)
+        docs = asyncio.run(collect(reader(col).find('db', 'col', {})))
+        self.assertEqual(docs, self.documents)
+        self.assertEqual((col.cursors[0].sorting, col.cursors[0].limited), (None, None))
+
+    def test_aggregate(self):
+        # pymongo's AsyncCollection.aggregate is awaited, motor's returns the cursor
+        for awaitable in (True, False):
+            col = FakeAsyncReadCollection(self.documents, awaitable_aggregate=awaitable)
+            docs = asyncio.run(collect(reader(col).aggregate('db', 'col', [{'$match': {}}])))
+            self.assertEqual(docs, self.documents)
+            self.assertEqual(col.pipelines, [([{'$match': {}}], {'allowDiskUse': True})])
+
+    def test_collections(self):
+        col = FakeAsyncReadCollection(self.documents)
+        self.assertEqual(asyncio.run(reader(col).collections('db')), ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,5 @@
+import time
+from types import SimpleNamespace
 import unittest
 import ijr.firefly as ff
 import os
@@ -14,5 +16,153 @@ class TestFF(unittest.TestCase):
         self.assertIsInstance(y, dict)
 
 
+class TestSecretCache(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+
+    def loader(self):
+        self.calls += 1
+        return {'MDB_USER': 'user', 'call': self.calls}
+
+    def test_latest_ttl(self):
+        cache = ff.SecretCache(ttl=0.05)
+        key = ('project', 'secret', 'latest')
+        self.assertEqual(cache.get(key, self.loader)['call'], 1)
+        self.assertEqual(cache.get(key, self.loader)['call'], 1)
+        time.sleep(0.06)
+        self.assertEqual(cache.get(key, self.loader)['call'], 2)
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['misses'], 2)
+
+    def test_pinned_version_is_permanent(self):
+        cache = ff.SecretCache(ttl=0)
+        key = ('project', 'secret', '5')
+        cache.get(key, self.loader)
+        cache.get(key, self.loader)
+        self.assertEqual(self.calls, 1)
+
+    def test_returns_copies(self):
+        cache = ff.SecretCache()
+        key = ('project', 'secret', 'latest')
+        cache.get(key, self.loader)['MDB_USER'] = 'changed'
+        self.assertEqual(cache.get(key, self.loader)['MDB_USER'], 'user')
+
+    def test_refresh_ahead(self):
+        cache = ff.SecretCache(ttl=10, refresh_ahead=10)
+        key = ('project', 'secret', 'latest')
+        cache.get(key, self.loader)
+        cache.get(key, self.loader)
+        for _ in range(100):
+            if cache.stats['refreshes']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(cache.stats['refreshes'], 1)
+        self.assertEqual(cache.get(key, self.loader)['call'], 2)
+
+
+class TestLazyNamespace(unittest.TestCase):
+    payload = {'name': 'prices', 'nested': {'value': 1},
+               'test_array': [{'test': 'index value 0'}, {'test': 'index value 1'}, [1, 2]]}
+
+    def test_same_access_as_nested_namespace(self):
+        eager = ff.NestedNamespace(self.payload)
+        lazy = ff.LazyNamespace(self.payload)
+        self.assertEqual(lazy.name, eager.name)
+        self.assertEqual(lazy.nested.value, eager.nested.value)
+        self.assertEqual(lazy.test_array.i1.test, eager.test_array.i1.test)
+        self.assertEqual(lazy.test_array.i2.i0, eager.test_array.i2.i0)
+        with self.assertRaises(AttributeError):
+            lazy.test_array.i3
+        with self.assertRaises(AttributeError):
+            lazy.missing
+
+    def test_indexing(self):
+        lazy = ff.LazyNamespace(self.payload)
+        self.assertEqual(lazy.test_array[0].test, 'index value 0')
+        self.assertEqual(lazy['test_array'][-1][1], 2)
+        self.assertEqual(len(lazy.test_array), 3)
+        self.assertEqual([item.test for item in lazy.test_array[:2]], ['index value 0', 'index value 1'])
+        self.assertEqual(list(lazy.nested), ['value'])
+        with self.assertRaises(IndexError):
+            lazy.test_array[3]
+
+    def test_children_cached_and_write_through(self):
+        payload = {'nested': {'value': 1}}
+        lazy = ff.LazyNamespace(payload)
+        self.assertIs(lazy.nested, lazy.nested)
+        lazy.nested.value = 2
+        self.assertEqual(payload['nested']['value'], 2)
+        lazy.nested = {'value': 3}
+        self.assertEqual(lazy.nested.value, 3)
+
+    def test_copy(self):
+        from copy import deepcopy
+        lazy = ff.LazyNamespace(self.payload)
+        self.assertEqual(deepcopy(lazy), lazy)
+
+
+class TestConfigCache(unittest.TestCase):
+    mongo = SimpleNamespace(MDB_SERVER='localhost', MDB_USER='user', MDB_PASS='pass')
+
+    def setUp(self):
+        self.calls = 0
+
+    def loader(self):
+        self.calls += 1
+        return {'_id': 'function', 'setting': self.calls}
+
+    def test_ttl(self):
+        cache = ff.ConfigCache(ttl=0.05)
+        self.assertEqual(cache.get(self.mongo, 'common', 'configs', 'function', self.loader)['setting'], 1)
+        self.assertEqual(cache.get(self.mongo, 'common', 'configs', 'function', self.loader)['setting'], 1)
+        time.sleep(0.06)
+        self.assertEqual(cache.get(self.mongo, 'common', 'configs', 'function', self.loader)['setting'], 2)
+        self.assertEqual(cache.stats['hits'], 1)
+
+    def test_invalidate(self):
+        cache = ff.ConfigCache()
+        cache.get(self.mongo, 'common', 'configs', 'function', self.loader)
+        cache.get(self.mongo, 'common', 'configs', 'other', self.loader)
+        cache.invalidate('localhost', 'common', 'configs', 'function')
+        self.assertEqual(cache.stats['entries'], 1)
+        cache.get(self.mongo, 'common', 'configs', 'function', self.loader)
+        self.assertEqual(self.calls, 3)
+
+    def test_invalidate_during_load(self):
+        for _id in ('function', None):
+            cache = ff.ConfigCache(mode='watch')
+            cache._watch = lambda *args: None
+
+            def loader():
+                doc = self.loader()
+                # the watcher reports a change after the document was read
+                cache.invalidate('localhost', 'common', 'configs', _id)
+                return doc
+
+            self.assertEqual(cache.get(self.mongo, 'common', 'configs', 'function', loader)['setting'],
+                             self.calls)
+            self.assertEqual(cache.stats['entries'], 0)
+            before = self.calls
+            cache.get(self.mongo, 'common', 'configs', 'function', self.loader)
+            cache.get(self.mongo, 'common', 'configs', 'function', self.loader)
+            self.assertEqual(self.calls, before + 1)
+            self.assertEqual(cache._loading, {})
+
+    def test_loader_error(self):
+        cache = ff.ConfigCache()
+
+        def loader():
+            raise RuntimeError('down')
+
+        with self.assertRaises(RuntimeError):
+            cache.get(self.mongo, 'common', 'configs', 'function', loader)
+        self.assertEqual((cache.stats['entries'], cache._loading), (0, {}))
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            ff.ConfigCache(mode='forever')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,212 @@
+import base64
+import datetime
+import decimal
+import json
+import sys
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+from bson import ObjectId
+
+from ijr import gcp_lib
+
+
+def installed(module):
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
+
+class FakePublisherClient(object):
+    """records published payloads, futures stay pending unless auto_resolve"""
+
+    def __init__(self, fail=False, auto_resolve=True):
+        self.published = list()
+        self.pending = list()
+        self.fail = fail
+        self.auto_resolve = auto_resolve
+
+    def publish(self, topic, data, **attrs):
+        self.published.append((topic, data, attrs))
+        future = Future()
+        if self.auto_resolve:
+            self.resolve(future)
+        else:
+            self.pending.append(future)
+        return future
+
+    def resolve(self, future):
+        if self.fail:
+            future.set_exception(RuntimeError('publish failed'))
+        else:
+            future.set_result(str(len(self.published)))
+
+    def resolve_all(self):
+        while self.pending:
+            self.resolve(self.pending.pop(0))
+
+
+def publisher(client, **kwargs):
+    with mock.patch.object(gcp_lib, 'running_in_gcf', return_value=True), \
+            mock.patch.object(gcp_lib.pubsub, 'PublisherClient', return_value=client):
+        return gcp_lib.PubSubPublisher('topic', **kwargs)
+
+
+class TestPubSubPublisher(unittest.TestCase):
+
+    def test_blocking(self):
+        client = FakePublisherClient()
+        with publisher(client, threshold=2, source='test') as p:
+            for i in range(4):
+                p.publish({'i': i})
+        self.assertEqual(len(client.published), 2)
+        topic, data, attrs = client.published[0]
+        self.assertEqual(json.loads(data), {'_type': 'Generic', 'data': [{'i': 0}, {'i': 1}, {'i': 2}]})
+        self.assertEqual(attrs, {'source': 'test'})
+
+    def test_non_blocking(self):
+        client = FakePublisherClient(auto_resolve=False)
+        p = publisher(client, threshold=0, blocking=False)
+        p.publish({'i': 0})
+        p.publish({'i': 1})
+        self.assertEqual(p._outstanding_messages, 2)
+        threading.Timer(0.05, client.resolve_all).start()
+        p.flush()
+        self.assertEqual(p._outstanding_messages, 0)
+
+    def test_non_blocking_backpressure(self):
+        client = FakePublisherClient(auto_resolve=False)
+        p = publisher(client, threshold=0, blocking=False, max_outstanding_messages=1)
+        p.publish({'i': 0})
+        threading.Timer(0.05, client.resolve_all).start()
+        p.publish({'i': 1})
+        self.assertEqual(len(client.published), 2)
+        client.resolve_all()
+        p.flush()
+
+    def test_non_blocking_failures(self):
+        client = FakePublisherClient(fail=True)
+        p = publisher(client, threshold=0, blocking=False)
+        p.publish({'i': 0})
+        with self.assertRaises(gcp_lib.PublishError) as cm:
+            p.flush()
+        self.assertEqual(cm.exception.failures[0][1], [{'i': 0}])
+        self.assertEqual(p.failures, [])
+
+    def test_envelope_matches_json_dumps(self):
+        client = FakePublisherClient()
+        msgs = [{'b': 1, 'a': datetime.date(2020, 1, 2)}, {'x': 'é'}]
+        with publisher(client, msg_type='Order') as p:
+            for msg in msgs:
+                p.publish(msg)
+        expected = json.dumps(dict(_type='Order', data=msgs), sort_keys=True, default=gcp_lib.default_object)
+        self.assertEqual(client.published[0][1], expected.encode())
+
+    def test_mongo_types(self):
+        client = FakePublisherClient()
+        _id = ObjectId('5f' * 12)
+        with publisher(client, serializer=gcp_lib.default_object) as p:
+            p.publish({'_id': _id, 'price': decimal.Decimal('1.10')})
+        self.assertEqual(gcp_lib.decode_message(client.published[0][1])['data'],
+                         [{'_id': str(_id), 'price': '1.10'}])
+
+    def test_custom_serializer(self):
+        client = FakePublisherClient()
+        with publisher(client, serializer=lambda o: 'custom') as p:
+            p.publish({'value': object()})
+        self.assertEqual(gcp_lib.decode_message(client.published[0][1])['data'], [{'value': 'custom'}])
+
+    def test_max_bytes(self):
+        client = FakePublisherClient()
+        with publisher(client, max_bytes=100) as p:
+            for i in range(10):
+                p.publish({'payload': 'x' * 20, 'i': i})
+        self.assertGreater(len(client.published), 1)
+        self.assertTrue(all(len(data) <= 100 for _, data, _ in client.published))
+        self.assertEqual(sum(len(json.loads(data)['data']) for _, data, _ in client.published), 10)
+
+    def test_message_too_large(self):
+        p = publisher(FakePublisherClient(), max_bytes=50)
+        with self.assertRaises(ValueError):
+            p.publish({'payload': 'x' * 100})
+
+    def test_max_latency(self):
+        client = FakePublisherClient()
+        p = publisher(client, max_latency=0.02)
+        p.publish({'i': 0})
+        for _ in range(100):
+            if client.published:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(client.published), 1)
+        p.flush()
+
+    def roundtrip(self, **kwargs):
+        client = FakePublisherClient()
+        msgs = [{'i': i, 'day': datetime.date(2020, 1, 2), 'name': 'é'} for i in range(20)]
+        with publisher(client, threshold=100, **kwargs) as p:
+            for msg in msgs:
+                p.publish(msg)
+        _, data, attrs = client.published[0]
+        envelope = gcp_lib.decode_message(data, attrs)
+        self.assertEqual(envelope['_type'], 'Generic')
+        self.assertEqual(envelope['data'], [dict(msg, day='2020-01-02') for msg in msgs])
+        return data, attrs
+
+    def test_gzip(self):
+        data, attrs = self.roundtrip(compression='gzip')
+        self.assertEqual(attrs, {'content_encoding': 'gzip'})
+
+    @unittest.skipUnless(installed('orjson'), 'orjson not installed')
+    def test_orjson(self):
+        data, attrs = self.roundtrip(encoder='orjson')
+        self.assertEqual(attrs, {})
+
+    @unittest.skipUnless(installed('orjson'), 'orjson not installed')
+    def test_orjson_big_int(self):
+        client = FakePublisherClient()
+        with publisher(client, encoder='orjson') as p:
+            p.publish({'b': 2 ** 70, 'a': 1})
+        self.assertEqual(gcp_lib.decode_message(client.published[0][1])['data'], [{'a': 1, 'b': 2 ** 70}])
+        self.assertIn(b'{"a":1,"b":', client.published[0][1])
+
+    @unittest.skipUnless(installed('msgpack'), 'msgpack not installed')
+    def test_msgpack(self):
+        data, attrs = self.roundtrip(encoder='msgpack')
+        self.assertEqual(attrs, {'content_type': 'application/msgpack'})
+
+    @unittest.skipUnless(installed('zstandard'), 'zstandard not installed')
+    def test_zstd(self):
+        self.roundtrip(encoder='auto', compression='zstd')
+
+    def test_missing_codec(self):
+        with mock.patch.dict(sys.modules, {'zstandard': None}):
+            with self.assertRaises(ImportError):
+                publisher(FakePublisherClient(), compression='zstd')
+
+    @unittest.skipUnless(installed('msgpack'), 'msgpack not installed')
+    def test_max_bytes_msgpack(self):
+        client = FakePublisherClient()
+        with publisher(client, max_bytes=100, encoder='msgpack') as p:
+            for i in range(10):
+                p.publish({'payload': 'x' * 20, 'i': i})
+        self.assertTrue(all(len(data) <= 100 for _, data, _ in client.published))
+        self.assertEqual(sum(len(gcp_lib.decode_message(data, attrs)['data'])
+                             for _, data, attrs in client.published), 10)
+
+    def test_decode_event(self):
+        client = FakePublisherClient()
+        with publisher(client, compression='gzip') as p:
+            p.publish({'i': 1})
+        _, data, attrs = client.published[0]
+        event = {'data': base64.b64encode(data).decode(), 'attributes': attrs}
+        self.assertEqual(gcp_lib.decode_message(event['data'], event['attributes'])['data'], [{'i': 1}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,337 @@
+import random
+import unittest
+from itertools import chain, starmap
+
+import datetime
+import decimal
+import json
+import uuid
+
+import bson
+from bson import Binary, Decimal128, ObjectId
+from bson.raw_bson import RawBSONDocument
+
+from ijr.generic_lib import (Compare, FingerprintCache, Serializer, default_object, dict_compare, fingerprint,
+                             fingerprints, json_dumps, serializer)
+
+
+def intersect_lists_reference(left_list, right_list):
+    """the original quadratic implementation"""
+    l = [value for value in left_list if value not in right_list]
+    m = [value for value in left_list if value in right_list]
+    r = [value for value in right_list if value not in left_list]
+    return l, m, r
+
+
+class CompareReference(object):
+    """the original recursive deepcompare and unnest"""
+
+    def listtodict(self, lst):
+        if not isinstance(lst, (list, dict)):
+            return lst
+        try:
+            result = {key: self.listtodict(value) for key, value in lst.items()}
+        except AttributeError:
+            result = {f'{index}': self.listtodict(value) for index, value in enumerate(lst)}
+        return result
+
+    def deepcompare(self, old_dict, new_dict, ignore_starting=None, ignore_ending=None):
+        if old_dict == new_dict:
+            return
+        result = {}
+        try:
+            old = Compare.exclude_keys(old_dict.keys(), ignore_starting, ignore_ending)
+            new = Compare.exclude_keys(new_dict.keys(), ignore_starting, ignore_ending)
+            for key in old - new:
+                result.update({key: {'action': 'del', 'old': old_dict[key]}})
+            for key in new - old:
+                result.update({key: {'action': 'add', 'new': new_dict[key]}})
+            for key in old & new:
+                if isinstance(old_dict[key], list) and isinstance(new_dict[key], list):
+                    value = self.deepcompare(self.listtodict(old_dict[key]), self.listtodict(new_dict[key]))
+                else:
+                    value = self.deepcompare(old_dict[key], new_dict[key])
+                if value is None:
+                    continue
+                if all(f'{index}' == key for index, key in enumerate(sorted(value.keys()))):
+                    value = [v for _, v in value.items()]
+                result.update({key: value})
+        except AttributeError:
+            if old_dict != new_dict:
+                result = {'action': 'mod', 'old': old_dict, 'new': new_dict}
+        finally:
+            if result:
+                return result
+
+    @staticmethod
+    def unnest(dictionary, separator='.'):
+        def unpack(parent_key, parent_value):
+            try:
+                for key, value in parent_value.items():
+                    yield (f'{parent_key}{separator}{key}', value)
+            except AttributeError:
+                yield (f'{parent_key}', parent_value)
+
+        if not isinstance(dictionary, dict):
+            return dictionary
+        while any(isinstance(value, dict) for value in dictionary.values()):
+            dictionary = dict(chain.from_iterable(starmap(unpack, dictionary.items())))
+        return dictionary
+
+
+def normalized(value):
+    """lists of changes sorted, their order used to follow set iteration"""
+    if isinstance(value, dict):
+        return {k: normalized(value[k]) for k in sorted(value, key=repr)}
+    if isinstance(value, list):
+        return sorted((normalized(v) for v in value), key=repr)
+    return value
+
+
+def random_document(rnd, depth=0):
+    kind = rnd.random()
+    if depth > 3 or kind < 0.4:
+        return rnd.choice([1, 2, 1.0, 'a', 'b', None, True])
+    if kind < 0.7:
+        return [random_document(rnd, depth + 1) for _ in range(rnd.randint(0, 4))]
+    return {rnd.choice('abcdef'): random_document(rnd, depth + 1) for _ in range(rnd.randint(0, 4))}
+
+
+def mutated(rnd, value):
+    if rnd.random() < 0.2:
+        return random_document(rnd, 2)
+    if isinstance(value, dict):
+        value = {k: mutated(rnd, v) for k, v in value.items() if rnd.random() > 0.1}
+        if rnd.random() < 0.2:
+            value[rnd.choice('abcdefg')] = random_document(rnd, 2)
+        return value
+    if isinstance(value, list):
+        return [mutated(rnd, v) for v in value if rnd.random() > 0.1]
+    return value
+
+
+class TestIntersectLists(unittest.TestCase):
+
+    def test_example(self):
+        self.assertEqual(Compare.intersect_lists([1, 2, 3], [2, 3, 4]), ([1], [2, 3], [4]))
+
+    def test_matches_reference(self):
+        rnd = random.Random(42)
+        values = [1, 1.0, True, 'a', None, (1, 2), [1, 2], [2, 1], {'sku': 1}, {'sku': 1, 'qty': [1]},
+                  {'qty': [1], 'sku': 1}, [{'a': 1}], {1, 2}, frozenset({1, 2}), ([1],)]
+        for _ in range(200):
+            left = [rnd.choice(values) for _ in range(rnd.randint(0, 10))]
+            right = [rnd.choice(values) for _ in range(rnd.randint(0, 10))]
+            self.assertEqual(Compare.intersect_lists(left, right), intersect_lists_reference(left, right))
+
+    def test_multiset(self):
+        self.assertEqual(Compare.intersect_lists([1, 1, 2], [1, 3], multiset=True), ([1, 2], [1], [3]))
+        self.assertEqual(Compare.intersect_lists([{'a': [1]}, {'a': [1]}], [{'a': [1]}], multiset=True),
+                         ([{'a': [1]}], [{'a': [1]}], []))
+        self.assertEqual(Compare.intersect_lists([1], [3, 1, 1], multiset=True), ([], [1], [3, 1]))
+
+    def test_unhashable_objects(self):
+        class Item(object):
+            __hash__ = None
+
+            def __init__(self, value):
+                self.value = value
+
+            def __eq__(self, other):
+                return isinstance(other, Item) and self.value == other.value
+
+        left, right = [Item(1), Item(2)], [Item(2), {'a': Item(3)}]
+        self.assertEqual(Compare.intersect_lists(left, right), intersect_lists_reference(left, right))
+
+
+class TestListMatching(unittest.TestCase):
+    old = {'lines': [{'sku': i, 'qty': 1} for i in range(100)]}
+
+    def test_index_default(self):
+        new = {'lines': [{'sku': -1, 'qty': 1}] + self.old['lines']}
+        self.assertEqual(len(Compare(self.old, new).result['lines']), 101)
+
+    def test_list_key(self):
+        lines = [{'sku': -1, 'qty': 1}] + [dict(line) for line in self.old['lines'][1:]]
+        lines[50]['qty'] = 2
+        result = Compare(self.old, {'lines': lines}, list_key='sku').result
+        self.assertEqual(result, {'lines': {'0': {'action': 'del', 'old': {'sku': 0, 'qty': 1}},
+                                            '50': {'qty': {'action': 'mod', 'old': 1, 'new': 2}},
+                                            '-1': {'action': 'add', 'new': {'sku': -1, 'qty': 1}}}})
+
+    def test_list_key_fallback(self):
+        result = Compare({'tags': ['a', 'b']}, {'tags': ['a', 'c']}, list_key='sku').result
+        self.assertEqual(result, {'tags': {'1': {'action': 'mod', 'old': 'b', 'new': 'c'}}})
+
+    def test_sequence(self):
+        new = {'lines': [{'sku': -1, 'qty': 1}] + self.old['lines'][:10] + [{'sku': 10, 'qty': 5}]
+                        + self.old['lines'][11:99]}
+        result = Compare(self.old, new, list_diff='sequence').result
+        self.assertEqual(result, {'lines': {'0': {'action': 'add', 'new': {'sku': -1, 'qty': 1}},
+                                            '11': {'qty': {'action': 'mod', 'old': 1, 'new': 5}},
+                                            '~99': {'action': 'del', 'old': {'sku': 99, 'qty': 1}}}})
+
+    def test_invalid_list_diff(self):
+        with self.assertRaises(ValueError):
+            Compare({}, {}, list_diff='myers')
+
+
+class TestDiffEngine(unittest.TestCase):
+
+    def test_matches_reference(self):
+        rnd = random.Random(7)
+        reference = CompareReference()
+        for _ in range(500):
+            old = {k: random_document(rnd) for k in 'abcdef'}
+            new = mutated(rnd, old)
+            compare = Compare(old, new)
+            expected = reference.deepcompare(old, new)
+            self.assertEqual(normalized(compare.result), normalized(expected))
+            self.assertEqual(normalized(compare.flatresult), normalized(reference.unnest(expected)))
+
+    def test_ignore_and_scalars(self):
+        self.assertEqual(Compare({'_ts': 1, 'a': 1}, {'_ts': 2, 'a': 1}, ignore_starting='_').result, None)
+        self.assertEqual(Compare(1, 2).result, {'action': 'mod', 'old': 1, 'new': 2})
+        self.assertEqual(Compare({'a': [1]}, {'a': 1}).result, {'a': {'action': 'mod', 'old': [1], 'new': 1}})
+
+    def test_changes(self):
+        old = {'a': {'b': [1, {'c': 2}]}, 'd': 1}
+        new = {'a': {'b': [1, {'c': 3}]}, 'e': [1]}
+        self.assertEqual(sorted(Compare(old, new).changes(), key=repr),
+                         sorted([(('d',), 'del', 1, None),
+                                 (('e',), 'add', None, [1]),
+                                 (('a', 'b', '1', 'c'), 'mod', 2, 3)], key=repr))
+
+    def test_unnest(self):
+        self.assertEqual(Compare.unnest({'a': {'b': {'c': {'d': ['e', 'f'], 'g': 5}}}}),
+                         {'a.b.c.d': ['e', 'f'], 'a.b.c.g': 5})
+        self.assertEqual(list(Compare.unnest({1: 1, 'x': {'y': {}, 'z': 2}, 'w': 3})), ['1', 'x.z', 'w'])
+
+    def test_deep_document(self):
+        old, new = {}, {}
+        node_old, node_new = old, new
+        for _ in range(5000):
+            node_old['n'], node_new['n'] = {}, {}
+            node_old, node_new = node_old['n'], node_new['n']
+        node_old['v'], node_new['v'] = 1, 2
+        self.assertEqual(len(list(Compare(old, new).changes())), 1)
+
+
+class TestFingerprints(unittest.TestCase):
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint({'a': 1, 'b': [1, {'c': 2}]}), fingerprint({'b': [1, {'c': 2}], 'a': 1}))
+        self.assertNotEqual(fingerprint({'a': [1, 2]}), fingerprint({'a': [2, 1]}))
+        self.assertNotEqual(fingerprint({'a': datetime.date(2020, 1, 1)}), fingerprint({'a': '2020-01-01'}))
+        self.assertEqual(fingerprint({1: 'a', 'b': 2}), fingerprint({'b': 2, 1: 'a'}))
+
+    def test_unequal_values_differ(self):
+        pairs = [((1, 2), [1, 2]), ({1: 'x'}, {'1': 'x'}), ({'a': 1}, ['d', ['a', 1]]), ({1, 2}, [1, 2]),
+                 (datetime.date(2020, 1, 1), ['o', 'datetime.date', 'datetime.date(2020, 1, 1)']),
+                 ([None], ['null']), ({(1, 2): 'x'}, {'[1, 2]': 'x'})]
+        for left, right in pairs:
+            self.assertNotEqual(fingerprint(left), fingerprint(right), (left, right))
+        self.assertEqual(fingerprint({1: 'a', 'b': 2, (1,): 3}), fingerprint({(1,): 3, 'b': 2, 1: 'a'}))
+        self.assertEqual(fingerprint({'s': {3, 1, 2}}), fingerprint({'s': {1, 2, 3}}))
+
+    def test_ignore_rules(self):
+        old = {'_id': 1, '_ts': 1, 'a': {'_ts': 1, 'b': 1}, 'c': [{'_ts': 1}]}
+        new = {'_id': 1, '_ts': 2, 'a': {'_ts': 2, 'b': 1}, 'c': [{'_ts': 1}]}
+        self.assertEqual(fingerprints(old, ignore_private=True), fingerprints(new, ignore_private=True))
+        self.assertNotEqual(fingerprints(old, ignore_starting='_')['a'], fingerprints(new, ignore_starting='_')['a'])
+        self.assertNotIn('_ts', fingerprints(old, ignore_starting='_'))
+
+    def test_cache(self):
+        cache = FingerprintCache(ignore_starting='_', maxsize=2)
+        self.assertIsNone(cache.changed_keys(1, {'_ts': 1, 'a': 1, 'b': 1}))
+        self.assertEqual(cache.changed_keys(1, {'_ts': 2, 'a': 1, 'b': 1}), set())
+        self.assertEqual(cache.changed_keys(1, {'_ts': 3, 'a': 2, 'c': 1}), {'a', 'b', 'c'})
+        cache.store(2, {})
+        cache.store(3, {})
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.changed_keys(1, {}))
+        self.assertEqual(cache.stats['unchanged'], 1)
+
+    def test_compare_with_cache(self):
+        cache = FingerprintCache(ignore_starting='_')
+        old = {'_ts': 1, 'a': {'b': [1, 2]}, 'c': 1}
+        cache.store('x', old)
+        unchanged = Compare(old, dict(old, _ts=2), ignore_starting='_', fingerprint_cache=cache, doc_id='x')
+        self.assertIsNone(unchanged.result)
+        changed = Compare(dict(old, _ts=2), dict(old, _ts=3, c=2), ignore_starting='_',
+                          fingerprint_cache=cache, doc_id='x')
+        self.assertEqual(changed.result, {'c': {'action': 'mod', 'old': 1, 'new': 2}})
+
+    def test_dict_compare_with_cache(self):
+        cache = FingerprintCache(ignore_private=True)
+        old = {'_ts': 1, 'a': {'_ts': 1, 'b': 1}, 'c': 1}
+        cache.store('x', old)
+        self.assertIsNone(dict_compare(old, {'_ts': 2, 'a': {'_ts': 2, 'b': 1}, 'c': 1},
+                                       fingerprint_cache=cache, doc_id='x'))
+        self.assertEqual(dict_compare(old, {'_ts': 2, 'a': {'b': 2}, 'c': 1}, fingerprint_cache=cache, doc_id='x'),
+                         {'a|b': {'old': 1, 'new': 2, 'action': 'mod'}})
+
+    def test_cache_sees_type_changes(self):
+        old, new = {'b': (1, 2)}, {'b': [1, 2]}
+        cache = FingerprintCache(ignore_private=True)
+        cache.store('x', old)
+        self.assertEqual(dict_compare(old, new, fingerprint_cache=cache, doc_id='x'), dict_compare(old, new))
+        for old, new in ((old, new), ({'b': {1: 'x'}}, {'b': {'1': 'x'}})):
+            cache.store('x', old)
+            self.assertIsNotNone(Compare(old, new).result)
+            self.assertEqual(Compare(old, new, fingerprint_cache=cache, doc_id='x').result, Compare(old, new).result)
+
+
+class TestSerializer(unittest.TestCase):
+
+    def test_default_types(self):
+        value = {'dt': datetime.datetime(2020, 1, 2, 3, 4, 5), 'd': datetime.date(2020, 1, 2),
+                 'x': decimal.Decimal('1.10'), 'u': uuid.UUID(int=1), 's': {3, 1}, 'b': b'hi', 'bin': Binary(b'x'),
+                 'o': ObjectId('5f' * 12), 'm': Decimal128('2.5'), 'raw': RawBSONDocument(bson.encode({'q': 1}))}
+        self.assertEqual(json.loads(json.dumps(value, default=default_object)),
+                         {'dt': '2020-01-02T03:04:05', 'd': '2020-01-02', 'x': '1.10',
+                          'u': '00000000-0000-0000-0000-000000000001', 's': [1, 3], 'b': 'aGk=', 'bin': 'eA==',
+                          'o': '5f' * 12, 'm': '2.5', 'raw': {'q': 1}})
+
+    def test_unknown_type(self):
+        with self.assertRaises(TypeError):
+            json.dumps(object(), default=default_object)
+
+    def test_register(self):
+        class Money(object):
+            def __init__(self, amount):
+                self.amount = amount
+
+        class Euro(Money):
+            pass
+
+        custom = serializer.copy()
+        with self.assertRaises(TypeError):
+            custom(Euro(1))
+
+        @custom.register(Money)
+        def money(m):
+            return m.amount
+
+        self.assertEqual(custom(Euro(2)), 2)
+        self.assertIs(custom.handler(Euro), money)
+        custom.register(Euro, lambda m: 'EUR %s' % m.amount)
+        self.assertEqual(custom(Euro(2)), 'EUR 2')
+        with self.assertRaises(TypeError):
+            serializer(Euro(1))
+
+    def test_register_by_name(self):
+        custom = Serializer()
+        custom.register('bson.timestamp.Timestamp', lambda ts: ts.time)
+        self.assertEqual(custom(bson.Timestamp(5, 1)), 5)
+
+    def test_json_dumps(self):
+        value = {'b': datetime.datetime(2020, 1, 2, 3, 4, 5, 6000), 'a': [ObjectId('5f' * 12), 'é'], 'n': 2 ** 70}
+        self.assertEqual(json.loads(json_dumps(value, sort_keys=True)),
+                         json.loads(json.dumps(value, default=default_object)))
+        self.assertTrue(json_dumps(value, sort_keys=True).startswith('{"a":'))
+        self.assertEqual(json_dumps(value, as_bytes=True), json_dumps(value).encode())
+
+
+if __name__ == '__main__':
+    unittest.main()
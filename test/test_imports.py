@@ -0,0 +1,49 @@
+import json
+import subprocess
+import sys
+import unittest
+
+# cold import budget per module, generous so slow CI machines don't flake
+IMPORT_BUDGET_SECONDS = 1.0
+HEAVY_MODULES = ('google.cloud.secretmanager_v1', 'google.cloud.pubsub', 'pymongo')
+
+SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import %s
+print(json.dumps(dict(seconds=time.perf_counter() - start, modules=sorted(sys.modules))))
+'''
+
+
+def cold_import(module):
+    """import module in a fresh interpreter -> (seconds, loaded module names)"""
+    out = subprocess.run([sys.executable, '-c', SCRIPT % module], check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    result = json.loads(out)
+    return result['seconds'], set(result['modules'])
+
+
+class TestImportBudget(unittest.TestCase):
+
+    def assertCheapImport(self, module, allowed=()):
+        seconds, modules = cold_import(module)
+        for heavy in HEAVY_MODULES:
+            if heavy not in allowed:
+                self.assertNotIn(heavy, modules, '%s imports %s' % (module, heavy))
+        self.assertLess(seconds, IMPORT_BUDGET_SECONDS, 'import %s took %.3fs' % (module, seconds))
+
+    def test_generic_lib(self):
+        self.assertCheapImport('ijr.generic_lib')
+
+    def test_firefly(self):
+        self.assertCheapImport('ijr.firefly')
+
+    def test_gcp_lib(self):
+        self.assertCheapImport('ijr.gcp_lib')
+
+    def test_mongo_lib_skips_google(self):
+        self.assertCheapImport('ijr.mongo_lib', allowed=('pymongo',))
+
+
+if __name__ == '__main__':
+    unittest.main()
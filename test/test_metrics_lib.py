@@ -0,0 +1,127 @@
+import logging
+import unittest
+from types import SimpleNamespace
+
+from ijr import firefly, metrics_lib
+from ijr.metrics_lib import LoggingMetrics, NullMetrics, OpenTelemetryMetrics, instrumented, set_metrics, timed
+from test_gcp_lib import FakePublisherClient, publisher
+from test_mongo_lib import FakeCollection, writer
+
+
+class RecordingMetrics(NullMetrics):
+    enabled = True
+
+    def __init__(self):
+        self.records = list()
+
+    def timing(self, name, seconds, **tags):
+        self.records.append(('timing', name, seconds, tags))
+
+    def histogram(self, name, value, **tags):
+        self.records.append(('histogram', name, value, tags))
+
+    def count(self, name, value=1, **tags):
+        self.records.append(('count', name, value, tags))
+
+    def values(self, name):
+        return [value for _, n, value, _ in self.records if n == name]
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = RecordingMetrics()
+        self.previous = set_metrics(self.metrics)
+
+    def tearDown(self):
+        set_metrics(self.previous)
+
+
+class TestRecorders(MetricsTestCase):
+
+    def test_default_is_noop(self):
+        set_metrics(None)
+        self.assertFalse(metrics_lib.get_metrics().enabled)
+        items = [1, 2]
+        self.assertIs(instrumented(items, 'x'), items)
+        with timed('x'):
+            pass
+
+    def test_timed_tags_errors(self):
+        with self.assertRaises(KeyError):
+            with timed('op.seconds', db='db'):
+                raise KeyError('x')
+        self.assertEqual(self.metrics.records[0][3], {'db': 'db', 'error': 'KeyError'})
+
+    def test_instrumented(self):
+        self.assertEqual(list(instrumented(iter(range(3)), 'scan', db='db')), [0, 1, 2])
+        self.assertEqual(self.metrics.values('scan.items'), [3])
+        self.assertEqual(len(self.metrics.values('scan.seconds')), 1)
+
+    def test_instrumented_closed_early(self):
+        items = instrumented(range(10), 'scan')
+        next(items)
+        items.close()
+        self.assertEqual(self.metrics.values('scan.items'), [1])
+
+    def test_logging(self):
+        with self.assertLogs('ijr.metrics', logging.INFO) as cm:
+            LoggingMetrics().count('cache.hits', cache='secrets')
+        self.assertIn('count cache.hits 1 cache=secrets', cm.output[0])
+
+    def test_opentelemetry(self):
+        try:
+            from opentelemetry.sdk.metrics import MeterProvider
+            from opentelemetry.sdk.metrics.export import InMemoryMetricReader
+        except ImportError:
+            self.skipTest('opentelemetry-sdk not installed')
+        reader = InMemoryMetricReader()
+        recorder = OpenTelemetryMetrics(meter=MeterProvider(metric_readers=[reader]).get_meter('test'))
+        recorder.count('cache.hits', cache='secrets')
+        recorder.count('cache.hits', cache='secrets')
+        with recorder.span('op.seconds'):
+            pass
+        metrics = reader.get_metrics_data().resource_metrics[0].scope_metrics[0].metrics
+        by_name = {metric.name: metric for metric in metrics}
+        self.assertEqual(by_name['cache.hits'].data.data_points[0].value, 2)
+        self.assertEqual(by_name['op.seconds'].data.data_points[0].count, 1)
+
+
+class TestHooks(MetricsTestCase):
+
+    def test_mongo_writer(self):
+        with writer(FakeCollection(), threshold=1) as mw:
+            for i in range(4):
+                mw.write_data({'i': i})
+        self.assertEqual(sum(self.metrics.values('mongo.bulk_write.docs')), 4)
+        self.assertEqual(len(self.metrics.values('mongo.bulk_write.seconds')), 2)
+
+    def test_pubsub_publisher(self):
+        with publisher(FakePublisherClient(), threshold=1) as p:
+            for i in range(3):
+                p.publish({'i': i})
+        self.assertEqual(self.metrics.values('pubsub.publish.messages'), [2, 1])
+        self.assertEqual(len(self.metrics.values('pubsub.publish.bytes')), 2)
+
+    def test_pubsub_publisher_non_blocking(self):
+        with publisher(FakePublisherClient(), threshold=0, blocking=False) as p:
+            p.publish({'i': 0})
+        self.assertEqual(len(self.metrics.values('pubsub.publish.seconds')), 1)
+
+    def test_secret_cache(self):
+        cache = firefly.SecretCache()
+        cache.get(('project', 'secret', 'latest'), dict)
+        cache.get(('project', 'secret', 'latest'), dict)
+        self.assertEqual(self.metrics.values('cache.misses'), [1])
+        self.assertEqual(self.metrics.values('cache.hits'), [1])
+
+    def test_config_cache(self):
+        mongo = SimpleNamespace(MDB_SERVER='localhost', MDB_USER='user', MDB_PASS='pass')
+        cache = firefly.ConfigCache()
+        cache.get(mongo, 'common', 'configs', 'function', dict)
+        cache.get(mongo, 'common', 'configs', 'function', dict)
+        self.assertEqual([r[3] for r in self.metrics.records], [{'cache': 'configs'}] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
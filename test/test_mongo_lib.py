@@ -0,0 +1,354 @@
+import threading
+import time
+import unittest
+from datetime import datetime
+
+import bson
+from bson import ObjectId
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.raw_bson import RawBSONDocument
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from ijr.mongo_lib import MongoClientRegistry, MongoReader, MongoWriter, PipelinedWriteError, client_registry
+
+
+class FakeCollection(object):
+    """stands in for a collection, records bulk_write batches
+
+    ReplaceOne and UpdateOne with top level $set/$unset are applied to `stored`
+    """
+    codec_options = DEFAULT_CODEC_OPTIONS
+
+    def __init__(self, delay=0, fail_on=None, find_delay=0):
+        self.batches = list()
+        self.delay = delay
+        self.fail_on = fail_on
+        self.find_delay = find_delay
+        self.ordered = list()
+        self.stored = dict()
+        self.finds = 0
+        self._lock = threading.Lock()
+
+    def bulk_write(self, statements, ordered=True):
+        time.sleep(self.delay)
+        for index, statement in enumerate(statements):
+            if self.fail_on is not None and getattr(statement, '_doc', {}).get('i') == self.fail_on:
+                raise BulkWriteError({'writeErrors': [{'index': index, 'code': 11000, 'errmsg': 'duplicate'}]})
+        with self._lock:
+            self.batches.append(list(statements))
+            self.ordered.append(ordered)
+            for statement in statements:
+                self.apply(statement)
+
+    def apply(self, statement):
+        if isinstance(statement, ReplaceOne):
+            self.store(dict(statement._doc, _id=statement._filter['_id']))
+        elif isinstance(statement, UpdateOne) and '_id' in statement._filter:
+            doc = self.load(statement._filter['_id']) or {'_id': statement._filter['_id']}
+            doc.update(statement._doc.get('$set', {}))
+            for field in statement._doc.get('$unset', {}):
+                doc.pop(field, None)
+            self.store(doc)
+
+    def store(self, doc):
+        self.stored[doc['_id']] = doc
+
+    def load(self, _id):
+        return dict(self.stored[_id]) if _id in self.stored else None
+
+    def find(self, query, projection=None, **kwargs):
+        self.finds += 1
+        ids = query['_id']['$in']
+        docs = [self.load(_id) for _id in ids if _id in self.stored]
+        time.sleep(self.find_delay)
+        return docs
+
+    def get_collection(self, name, **kwargs):
+        return self
+
+    def get_database(self, name, **kwargs):
+        return self
+
+    def close(self):
+        pass
+
+
+class BsonCollection(FakeCollection):
+    """FakeCollection keeping the stored documents as BSON, like the server"""
+
+    def store(self, doc):
+        self.stored[doc['_id']] = bson.encode(doc)
+
+    def load(self, _id):
+        return bson.decode(self.stored[_id]) if _id in self.stored else None
+
+
+def writer(collection, **kwargs):
+    mw = MongoWriter('localhost', 'user', 'pass', 'db', 'col', connect=False, **kwargs)
+    mw._client.close()
+    mw._client = collection
+    return mw
+
+
+class TestMongoClientRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MongoClientRegistry(max_pool_size=5)
+
+    def tearDown(self):
+        self.registry.close_all()
+
+    def test_reuse(self):
+        a = self.registry.acquire('localhost', 'user', 'pass', connect=False)
+        b = self.registry.acquire('localhost', 'user', 'pass', connect=False)
+        self.assertIs(a, b)
+        self.assertEqual(a.options.pool_options.max_pool_size, 5)
+        self.assertEqual(self.registry.stats['handshakes'], 1)
+        self.assertEqual(self.registry.stats['handshakes_avoided'], 1)
+        self.assertEqual(self.registry.stats['borrowed'], 2)
+        self.registry.release(a)
+        self.assertEqual(self.registry.stats['borrowed'], 1)
+
+    def test_keyed(self):
+        a = self.registry.acquire('localhost', 'user', 'pass', connect=False)
+        b = self.registry.acquire('localhost', 'other', 'pass', connect=False)
+        c = self.registry.acquire('localhost', 'user', 'pass', connect=False, max_idle_time_ms=1000)
+        self.assertIsNot(a, b)
+        self.assertIsNot(a, c)
+        self.assertEqual(self.registry.stats['clients'], 3)
+
+    def test_reader_borrows(self):
+        with MongoReader('localhost', 'user', 'pass', pooled=True, connect=False) as mr:
+            client = mr._client
+        with MongoReader('localhost', 'user', 'pass', pooled=True, connect=False) as mr:
+            self.assertIs(mr._client, client)
+        client_registry.close_all()
+
+
+class TestMongoWriter(unittest.TestCase):
+
+    def test_sync(self):
+        col = FakeCollection()
+        with writer(col, threshold=2) as mw:
+            for i in range(5):
+                mw.write_data({'i': i})
+        self.assertEqual([len(b) for b in col.batches], [3, 2])
+
+    def test_pipelined(self):
+        col = FakeCollection(delay=0.01)
+        with writer(col, threshold=9, workers=2, ordered=False) as mw:
+            for i in range(100):
+                mw.write_data({'i': i})
+        self.assertEqual(sum(len(b) for b in col.batches), 100)
+        self.assertEqual(set(col.ordered), {False})
+
+    def test_pipelined_errors(self):
+        col = FakeCollection(fail_on=13)
+        mw = writer(col, threshold=9, workers=1)
+        for i in range(30):
+            mw.write_data({'i': i})
+        with self.assertRaises(PipelinedWriteError) as cm:
+            mw.close()
+        self.assertEqual(len(cm.exception.errors), 1)
+        # the server stops an ordered batch at the failing statement
+        self.assertEqual([op._doc['i'] for op in cm.exception.operations], list(range(13, 20)))
+        self.assertIsInstance(cm.exception.operations[0], InsertOne)
+        self.assertEqual(sum(len(b) for b in col.batches), 20)
+
+    def test_pipelined_errors_unordered(self):
+        col = FakeCollection(fail_on=13)
+        mw = writer(col, threshold=9, workers=1, ordered=False)
+        for i in range(30):
+            mw.write_data({'i': i})
+        with self.assertRaises(PipelinedWriteError) as cm:
+            mw.close()
+        self.assertEqual([op._doc['i'] for op in cm.exception.operations], [13])
+
+    def test_exit_keeps_caller_exception(self):
+        col = FakeCollection(fail_on=3)
+        with self.assertRaises(KeyError):
+            with writer(col, threshold=1, workers=1) as mw:
+                for i in range(6):
+                    mw.write_data({'i': i})
+                raise KeyError('caller')
+        self.assertEqual(sum(len(b) for b in col.batches), 4)
+
+    def test_max_bytes(self):
+        col = FakeCollection()
+        with writer(col, max_bytes=1000) as mw:
+            for i in range(20):
+                mw.write_data({'i': i, 'payload': 'x' * 200}, force_timestamp=False)
+        self.assertGreater(len(col.batches), 4)
+        self.assertTrue(all(len(b) <= 4 for b in col.batches))
+        self.assertEqual(mw.stats.docs, 20)
+        self.assertGreater(mw.stats.bytes, 20 * 200)
+
+    def test_adaptive(self):
+        col = FakeCollection()
+        with writer(col, threshold=10, adaptive=True, max_threshold=40) as mw:
+            for i in range(200):
+                mw.write_data({'i': i})
+            self.assertEqual(mw.threshold, 40)
+            col.delay = 0.02
+            mw._target_latency = 0.01
+            for i in range(100):
+                mw.write_data({'i': i})
+            self.assertLess(mw.threshold, 40)
+
+    def test_stats(self):
+        col = FakeCollection()
+        with writer(col, threshold=1) as mw:
+            for i in range(4):
+                mw.write_data({'i': i})
+        stats = mw.stats.as_dict()
+        self.assertEqual(stats['batches'], 2)
+        self.assertEqual(stats['docs'], 4)
+        self.assertEqual(sum(stats['latency_histogram'].values()), 2)
+
+    def test_write_document(self):
+        col = FakeCollection()
+        _id = ObjectId()
+        with writer(col) as mw:
+            mw.write_document({'_id': _id, 'i': 0})
+            mw.write_document({'i': 1})
+        replace, insert = col.batches[0]
+        self.assertEqual(replace._filter, {'_id': _id})
+        self.assertEqual(replace._doc, {'_id': _id, 'i': 0})
+        self.assertIsInstance(insert, InsertOne)
+
+
+class TestChangeDetection(unittest.TestCase):
+
+    def setUp(self):
+        self.col = FakeCollection()
+        self.col.stored = {'1': {'_id': '1', '_ts': 1, 'a': 1, 'b': {'c': 1, 'd': 1}, 'e': 1},
+                           '2': {'_id': '2', '_ts': 1, 'a': 1}}
+
+    def test_detect_changes(self):
+        with writer(self.col, detect_changes=True) as mw:
+            mw.write_data({'a': 1, 'b': {'c': 2, 'd': 1}, 'f': 1}, doc_key='1')
+            mw.write_data({'a': 1}, doc_key='2')
+            mw.write_data({'a': 1}, doc_key='3')
+        statements = self.col.batches[0]
+        self.assertEqual(len(statements), 2)
+        update = statements[0]._doc
+        self.assertEqual(set(update['$set']), {'b.c', 'f', '_ts'})
+        self.assertEqual(update['$set']['b.c'], 2)
+        self.assertEqual(update['$unset'], {'e': ''})
+        self.assertIsInstance(statements[1], ReplaceOne)
+        self.assertEqual((mw.stats.updated, mw.stats.skipped, mw.stats.inserted), (1, 1, 1))
+
+    def test_same_document_twice_in_batch(self):
+        with writer(self.col, detect_changes=True) as mw:
+            mw.write_data({'a': 2}, doc_key='2')
+            mw.write_data({'a': 1}, doc_key='2')
+        self.assertEqual([st._doc['$set']['a'] for st in self.col.batches[0]], [2, 1])
+
+    def test_after_edit(self):
+        with writer(self.col, detect_changes=True) as mw:
+            mw.edit_data({'_id': '2'}, {'a': 5}, 'one')
+            mw.write_data({'a': 1}, doc_key='2')
+        self.assertIsInstance(self.col.batches[0][1], ReplaceOne)
+        self.assertEqual(mw.stats.replaced, 1)
+
+    def unchanged_feed(self, count):
+        self.col.stored = {str(i): {'_id': str(i), '_ts': 1, 'i': i, 'payload': 'x' * 20} for i in range(count)}
+        return [{'i': i, 'payload': 'x' * 20} for i in range(count)]
+
+    def test_max_bytes(self):
+        with writer(self.col, detect_changes=True, max_bytes=4000) as mw:
+            for doc in self.unchanged_feed(400):
+                mw.write_data(doc, doc_key=str(doc['i']))
+        self.assertEqual((mw.stats.skipped, mw.stats.replaced), (400, 0))
+        self.assertEqual(self.col.batches, [])
+
+    def test_skipped_batches_reset_size(self):
+        with writer(self.col, detect_changes=True, threshold=2, max_bytes=1000) as mw:
+            for doc in self.unchanged_feed(30):
+                mw.write_data(doc, doc_key=str(doc['i']))
+            self.assertLess(mw._statements_bytes, 200)
+        self.assertEqual(mw.stats.skipped, 30)
+        self.assertEqual(self.col.finds, 10)
+
+    def test_inflight_batch_done_during_find(self):
+        self.col.delay = 0.02
+        self.col.find_delay = 0.1
+        with writer(self.col, detect_changes=True, workers=1, threshold=0) as mw:
+            mw.write_data({'a': 2}, doc_key='2')
+            # the find reads a=1 before the first batch is written and returns after it is done
+            mw.write_data({'a': 1}, doc_key='2')
+        self.assertEqual((mw.stats.updated, mw.stats.skipped), (2, 0))
+        self.assertEqual(self.col.stored['2']['a'], 1)
+
+    def test_bson_round_trip(self):
+        col = BsonCollection()
+        feed = [{'when': datetime(2020, 1, 1, 12, 0, 0, 123456)}, {'pair': (1, 2)}, {'a': 1}]
+        for run in range(3):
+            with writer(col, detect_changes=True) as mw:
+                for i, doc in enumerate(feed):
+                    mw.write_data(dict(doc), doc_key=str(i))
+            self.assertEqual(mw.stats.inserted if run == 0 else mw.stats.skipped, 3)
+        self.assertEqual(len(col.batches), 1)
+
+    def test_unaddressable_field(self):
+        self.col.stored['1']['b'] = {'x.y': 1}
+        with writer(self.col, detect_changes=True) as mw:
+            mw.write_data({'a': 1, 'b': {'x.y': 2}, 'e': 1}, doc_key='1')
+        self.assertEqual(self.col.batches[0][0]._doc['$set']['b'], {'x.y': 2})
+
+
+class TestMongoReader(unittest.TestCase):
+
+    def test_find_kwargs(self):
+        self.assertEqual(MongoReader._find_kwargs('a', -1, None, None, None), {'sort': [('a', 1)]})
+        self.assertEqual(MongoReader._find_kwargs([('a', -1)], 5, 100, 'a_1', 1000),
+                         {'sort': [('a', -1)], 'limit': 5, 'batch_size': 100, 'hint': 'a_1', 'max_time_ms': 1000})
+
+    def test_partitions(self):
+        others = [{'_id': 'a'}, {'_id': ObjectId()}, {'_id': 'b'}]
+        docs = [{'_id': i} for i in range(1000)] + others
+
+        def aggregate(db_name, collection_name, pipeline):
+            return ({'_key': d['_id']} for d in docs[::10] + others)
+
+        def matches(value, condition):
+            if '$not' in condition:
+                return not isinstance(value, int)
+            return isinstance(value, int) and condition.get('$gte', 0) <= value < condition.get('$lt', 1000)
+
+        def find_batches(db_name, collection_name, query, **kwargs):
+            selected = [d for d in docs if matches(d['_id'], query.get('_id', {}))]
+            for i in range(0, len(selected), 50):
+                yield selected[i:i + 50]
+
+        with MongoReader('localhost', 'user', 'pass', connect=False) as mr:
+            mr.aggregate = aggregate
+            mr.find_batches = find_batches
+            self.assertEqual(mr.partition_bounds('db', 'col', {}, partitions=4), [250, 500, 750])
+            queries = mr.partition_queries('db', 'col', {}, partitions=4)
+            self.assertEqual(queries[0], {'_id': {'$lt': 250}})
+            self.assertEqual(queries[1], {'_id': {'$gte': 250, '$lt': 500}})
+            self.assertEqual(queries[4], {'_id': {'$not': {'$type': 'number'}}})
+            self.assertEqual(mr.partition_queries('db', 'col', {'a': 1}, partitions=2)[1],
+                             {'$and': [{'a': 1}, {'_id': {'$gte': 500}}]})
+            found = list(mr.parallel_find('db', 'col', {}, partitions=4))
+            self.assertEqual(sorted(d['_id'] for d in found if isinstance(d['_id'], int)), list(range(1000)))
+            self.assertEqual(len(found), len(docs))
+            scan = mr.parallel_find('db', 'col', {}, partitions=4)
+            next(scan)
+            scan.close()
+
+    def test_partitions_without_range_type(self):
+        with MongoReader('localhost', 'user', 'pass', connect=False) as mr:
+            mr.aggregate = lambda *args: ({'_key': {'a': i}} for i in range(100))
+            self.assertEqual(mr.partition_queries('db', 'col', {'a': 1}), [{'a': 1}])
+
+    def test_raw_bson_collection(self):
+        with MongoReader('localhost', 'user', 'pass', connect=False) as mr:
+            col = mr._collection('db', 'col', raw_bson=True)
+            self.assertIs(col.codec_options.document_class, RawBSONDocument)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from decimal import Decimal
+
+import bson
+from bson import Decimal128, ObjectId
+
+from ijr.transfer_lib import export_collection, import_collection, read_export
+
+
+class FakeReader(object):
+    """serves find_raw_batches from a list of documents sorted by _id"""
+
+    def __init__(self, documents):
+        self.documents = sorted(documents, key=lambda doc: doc['_id'])
+        self.queries = list()
+
+    def find_raw_batches(self, db_name, collection_name, query, sorting=None, projection=None, batch_size=1000):
+        self.queries.append(query)
+        after = query.get('_id', {}).get('$gt')
+        documents = [doc for doc in self.documents if after is None or doc['_id'] > after]
+        for start in range(0, len(documents), batch_size):
+            yield b''.join(bson.encode(doc) for doc in documents[start:start + batch_size])
+
+
+class FakeWriter(object):
+
+    def __init__(self):
+        self.documents = list()
+
+    def write_document(self, doc):
+        self.documents.append(doc)
+
+
+class TestTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.documents = [{'_id': ObjectId(), 'i': i, 'when': datetime(2020, 1, 1, 12, 0, i),
+                           'price': Decimal128(Decimal('%d.10' % i)), 'tags': ['a', {'b': i}]}
+                          for i in range(25)]
+        self.reader = FakeReader(self.documents)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_round_trip(self):
+        for name in ('export.jsonl', 'export.jsonl.gz', 'export.bson', 'export.bson.gz'):
+            path = self.path(name)
+            result = export_collection(self.reader, 'db', 'col', path, batch_size=10)
+            self.assertEqual(result, dict(docs=25, last_id=self.documents[-1]['_id']))
+            writer = FakeWriter()
+            self.assertEqual(import_collection(writer, path)['docs'], 25)
+            self.assertEqual(writer.documents, self.documents, name)
+
+    def test_extended_json(self):
+        path = self.path('export.jsonl')
+        export_collection(self.reader, 'db', 'col', path)
+        with open(path) as f:
+            line = f.readline()
+        self.assertIn('"$oid"', line)
+        self.assertIn('"$date"', line)
+
+    def test_resume_partial_line(self):
+        path = self.path('export.jsonl')
+        export_collection(FakeReader(self.documents[:10]), 'db', 'col', path)
+        with open(path, 'ab') as f:
+            f.write(b'{"_id": {"$oid": "5f')
+        result = export_collection(self.reader, 'db', 'col', path, resume=True)
+        self.assertEqual(result['docs'], 15)
+        self.assertEqual(self.reader.queries[-1], {'_id': {'$gt': self.documents[9]['_id']}})
+        self.assertEqual(list(read_export(path)), self.documents)
+
+    def test_resume_truncated_gzip(self):
+        path = self.path('export.bson.gz')
+        export_collection(FakeReader(self.documents[:10]), 'db', 'col', path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data[:-10])
+        result = export_collection(self.reader, 'db', 'col', path, resume=True)
+        self.assertEqual(list(read_export(path)), self.documents)
+        self.assertEqual(result['last_id'], self.documents[-1]['_id'])
+
+    def test_partial_file_raises_on_import(self):
+        path = self.path('export.bson')
+        export_collection(self.reader, 'db', 'col', path)
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 3)
+        with self.assertRaises(EOFError):
+            import_collection(FakeWriter(), path)
+
+    def test_import_after_id(self):
+        path = self.path('export.jsonl.gz')
+        export_collection(self.reader, 'db', 'col', path)
+        with gzip.open(path) as f:
+            self.assertEqual(len(f.readlines()), 25)
+        writer = FakeWriter()
+        result = import_collection(writer, path, after_id=self.documents[19]['_id'])
+        self.assertEqual(writer.documents, self.documents[20:])
+        self.assertEqual(result['last_id'], self.documents[-1]['_id'])
+
+    def test_import_after_unknown_id(self):
+        path = self.path('export.jsonl')
+        export_collection(self.reader, 'db', 'col', path)
+        with self.assertRaises(ValueError):
+            import_collection(FakeWriter(), path, after_id=ObjectId())
+
+    def test_import_after_last_id(self):
+        path = self.path('export.jsonl')
+        export_collection(self.reader, 'db', 'col', path)
+        result = import_collection(FakeWriter(), path, after_id=self.documents[-1]['_id'])
+        self.assertEqual(result, dict(docs=0, last_id=None))
+
+
+if __name__ == '__main__':
+    unittest.main()